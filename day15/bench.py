@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+#  Advent of Code 2018 - Day 15 benchmarks
+#
+from contextlib import redirect_stdout
+import argparse
+import io
+import random
+import time
+import tracemalloc
+
+from day15 import (
+    Battles, Board, GridBoard, ELF, GOBLIN, EMPTY, ROCK,
+    propagate, search_power,
+)
+
+FLOOD_SIZES = [16, 32, 64, 128, 256]
+ARENA_SIZES = [32, 64, 128, 256, 512]
+
+BOARDS = {"grid": GridBoard, "dict": Board}
+
+
+def open_arena(size: int) -> list[str]:
+    """Return the lines of a square arena with no interior walls, and a
+    single elf in the top left corner.
+    """
+    lines = [ROCK * (size + 2)]
+    for r in range(size):
+        row = EMPTY * size
+        if r == 0:
+            row = ELF + row[1:]
+        lines.append(ROCK + row + ROCK)
+    lines.append(ROCK * (size + 2))
+    return lines
+
+
+def generate_cave(
+    size: int,
+    wall_density: float = 0.1,
+    units: int = 20,
+    seed: int = 0
+) -> list[str]:
+    """Return the lines of a random square cave, surrounded by rock.
+    Each interior cell is rock with probability wall_density.  The given
+    number of units are placed on open cells, alternating elves and goblins.
+    The same seed always gives the same cave.
+    """
+    rng = random.Random(seed)
+    rows = [
+        [ROCK if rng.random() < wall_density else EMPTY for _ in range(size)]
+        for _ in range(size)
+    ]
+    cells = [(r, c) for r in range(size) for c in range(size) if rows[r][c] == EMPTY]
+    for n, (r, c) in enumerate(rng.sample(cells, min(units, len(cells)))):
+        rows[r][c] = ELF if n % 2 == 0 else GOBLIN
+
+    lines = [ROCK * (size + 2)]
+    for row in rows:
+        lines.append(ROCK + "".join(row) + ROCK)
+    lines.append(ROCK * (size + 2))
+    return lines
+
+
+def bench_flood(sizes=FLOOD_SIZES, repeat: int = 5) -> None:
+    """Time a distances() flood fill from one corner of an open arena,
+    for each board backend and arena size.
+    """
+    print("FLOOD:")
+    print(f"{'size':>6s} {'cells':>8s} {'Board (ms)':>12s} {'GridBoard (ms)':>15s}")
+    for size in sizes:
+        lines = open_arena(size)
+        times = []
+        for board_cls in (Board, GridBoard):
+            board = board_cls.from_lines(lines)
+            start = board.locate(ELF)[0]
+            best = None
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                board.distances(start)
+                elapsed = time.perf_counter() - t0
+                if best is None or elapsed < best:
+                    best = elapsed
+            times.append(best * 1000)
+        print(f"{size:>6d} {size * size:>8d} {times[0]:>12.2f} {times[1]:>15.2f}")
+    print("= " * 32)
+
+
+def run_part1(lines, board_cls) -> tuple[float, int]:
+    """Play one battle, and return the elapsed time and the number of
+    rounds played.
+    """
+    board = board_cls.from_lines(lines)
+    t0 = time.perf_counter()
+    propagate(board)
+    elapsed = time.perf_counter() - t0
+    return elapsed, board.rounds
+
+
+def run_part2(lines, board_cls) -> tuple[float, int]:
+    """Search for the lowest winning elf power, and return the elapsed time
+    and the number of rounds played.
+    """
+    battles = Battles(lines, board_cls, fork=True)
+    t0 = time.perf_counter()
+    try:
+        search_power(lines, board_cls, battles=battles)
+    except ValueError:
+        pass
+    elapsed = time.perf_counter() - t0
+    return elapsed, battles.rounds_played
+
+
+def measure(run, lines, board_cls) -> tuple[float, int, int]:
+    """Return the elapsed time, rounds played and peak traced memory for
+    the given benchmark.  Memory is measured on a second run, so that
+    tracing doesn't distort the timing.
+    """
+    with redirect_stdout(io.StringIO()):
+        elapsed, rounds = run(lines, board_cls)
+
+        tracemalloc.start()
+        run(lines, board_cls)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, rounds, peak
+
+
+def bench_arenas(
+    sizes=ARENA_SIZES,
+    wall_density: float = 0.1,
+    units: int = 20,
+    seed: int = 0,
+    board_cls: type = GridBoard,
+    part2: bool = False
+) -> None:
+    """Play generated caves of increasing size, and report rounds per
+    second and peak memory for each.
+    """
+    run = run_part2 if part2 else run_part1
+    print(f"ARENAS ({'part 2' if part2 else 'part 1'}, {board_cls.__name__}, "
+          f"density={wall_density}, units={units}, seed={seed}):")
+    print(f"{'size':>6s} {'rounds':>8s} {'seconds':>9s} {'rounds/s':>10s} {'peak (MB)':>10s}")
+    for size in sizes:
+        lines = generate_cave(size, wall_density, units, seed)
+        elapsed, rounds, peak = measure(run, lines, board_cls)
+        rate = rounds / elapsed if elapsed else 0.0
+        print(f"{size:>6d} {rounds:>8d} {elapsed:>9.2f} {rate:>10.1f} {peak / 2**20:>10.2f}")
+    print("= " * 32)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Day 15 benchmarks")
+    parser.add_argument("--flood", action="store_true", help="benchmark distances() only")
+    parser.add_argument("--part2", action="store_true", help="benchmark the elf power search")
+    parser.add_argument("--sizes", type=int, nargs="+", default=ARENA_SIZES)
+    parser.add_argument("--density", type=float, default=0.1, help="wall density")
+    parser.add_argument("--units", type=int, default=20, help="number of units")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--board", choices=BOARDS, default="grid")
+    args = parser.parse_args()
+
+    if args.flood:
+        bench_flood()
+        return
+    bench_arenas(
+        args.sizes, args.density, args.units, args.seed, BOARDS[args.board],
+        part2=args.part2
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,17 @@
 #
 #  Advent of Code 2018 - Day 15
 #
-from typing import Sequence, Union, Optional, Any
+from typing import Sequence, Union, Optional, Any, List
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
 from dataclasses import dataclass
+from array import array
+import multiprocessing
+import json
 import math
+import os
 import re
+import time
 
 INPUTFILE = "input.txt"
 
@@ -201,8 +206,12 @@ Cell = str
 EMPTY, ROCK, ELF, GOBLIN = ".", "#", "E", "G"
 FOE = {ELF: GOBLIN, GOBLIN: ELF}
 
+ORD_EMPTY, ORD_ROCK, ORD_ELF, ORD_GOBLIN = map(ord, (EMPTY, ROCK, ELF, GOBLIN))
+ORD_FOE = {ORD_ELF: ORD_GOBLIN, ORD_GOBLIN: ORD_ELF}
+
 DEFAULT_HIT_POINTS = 200
 DEFAULT_ATTACK_POWER = 3
+MAX_ELF_POWER = DEFAULT_HIT_POINTS  # every hit kills
 
 
 @dataclass(order=True, frozen=True)
@@ -221,6 +230,122 @@ class Pos():
             Pos(self.row - 1, self.col),
         ]
 
+@dataclass(eq=False)
+class Unit():
+    """A single elf or goblin."""
+    name: str
+    kind: Cell
+    pos: Any
+
+
+class UnitIndex():
+    """An incrementally maintained index of the living units on a board,
+    by position and by faction.
+    """
+    at: dict[Any, Unit]
+    faction: dict[Cell, set]
+
+    def __init__(self):
+        self.at = {}
+        self.faction = {ELF: set(), GOBLIN: set()}
+
+    def add(self, unit: Unit) -> None:
+        self.at[unit.pos] = unit
+        self.faction[unit.kind].add(unit.pos)
+
+    def move(self, pos, dest) -> None:
+        unit = self.at.pop(pos)
+        positions = self.faction[unit.kind]
+        positions.remove(pos)
+        positions.add(dest)
+        unit.pos = dest
+        self.at[dest] = unit
+
+    def remove(self, pos) -> Unit:
+        unit = self.at.pop(pos)
+        self.faction[unit.kind].remove(pos)
+        return unit
+
+    def position(self, unit: Unit) -> Pos:
+        return unit.pos
+
+    def kind(self, unit: Unit) -> Cell:
+        return unit.kind
+
+    def alive(self, unit: Unit) -> bool:
+        return self.at.get(unit.pos) is unit
+
+    def count(self, kind: Cell) -> int:
+        """Return the number of living units of the given type."""
+        return len(self.faction[kind])
+
+    def locate(self, kind: Cell) -> list:
+        """Return the sorted positions of all units of the given type."""
+        return sorted(self.faction[kind])
+
+    def in_order(self) -> List[Unit]:
+        """Return all living units, in reading order."""
+        return [self.at[pos] for pos in sorted(self.at)]
+
+
+@dataclass(frozen=True)
+class Snapshot():
+    """The state of a battle at the start of a round.
+
+    Hit points aren't stored.  Instead we keep the number of hits each unit
+    has taken, so that the battle can be resumed with a different elf
+    attack power.
+    """
+    rounds: int                 # rounds completed
+    cells: Any                  # grid contents, in the board's own format
+    width: int                  # grid width, for array-backed boards
+    units: dict[Any, str]       # position -> name of each living unit
+    hits: dict[str, int]        # name -> number of hits taken
+    initial_elves: int
+
+    def valid_for(self, elf_power: int) -> bool:
+        """Return True if a battle with the given elf attack power would
+        also have reached this state.  That is the case if every goblin
+        hit so far has had the same outcome (killed or not) at that power.
+        """
+        fatal = -(-DEFAULT_HIT_POINTS // elf_power)  # hits needed to kill
+        living = set(self.units.values())
+        for name, hits in self.hits.items():
+            if name[0] != GOBLIN:
+                continue
+            if name in living:
+                if hits >= fatal:
+                    return False
+            elif hits != fatal:
+                return False
+        return True
+
+    def fork_key(self) -> int:
+        """Return the most hits taken by any living goblin, or -1 once a
+        goblin has been killed.  Two snapshots of the same battle with the
+        same key are valid for the same elf powers, so only the later one
+        need be kept.
+        """
+        living = set(self.units.values())
+        most = 0
+        for name, hits in self.hits.items():
+            if name[0] != GOBLIN:
+                continue
+            if name not in living:
+                return -1
+            most = max(most, hits)
+        return most
+
+
+def restore_hits(board, snap: Snapshot) -> None:
+    """Set the hit points of the units on a board forked from a snapshot."""
+    board.initial_elves = snap.initial_elves
+    board.hits.update(snap.hits)
+    for name, hits in snap.hits.items():
+        power = board.elf_power if name[0] == GOBLIN else DEFAULT_ATTACK_POWER
+        board.hit_points[name] = DEFAULT_HIT_POINTS - hits * power
+
+
 class Board():
     grid: dict[Pos, Cell]
 
@@ -231,15 +356,22 @@ class Board():
         self.colmax = max([v.col for v in self.grid.keys()])
         self.colmin = min([v.col for v in self.grid.keys()])
         self.hit_points = defaultdict(lambda: DEFAULT_HIT_POINTS)
+        self.hits = defaultdict(int)
+        self.elf_power = elf_power
+        self._dists = defaultdict(lambda: -1)
+        self._first = {}
+        self.rounds = 0     # full rounds completed by propagate()
 
+        self.units = UnitIndex()
         self.power = {}
-        for elf in self.locate(ELF):
-            name = self.grid[elf]
-            self.power[name] = elf_power
-        for gob in self.locate(GOBLIN):
-            name = self.grid[gob]
-            self.power[name] = DEFAULT_ATTACK_POWER
-
+        for pos, name in list(self.grid.items()):
+            if name[0] in (ELF, GOBLIN):
+                self.units.add(Unit(name, name[0], pos))
+                if name[0] == ELF:
+                    self.power[name] = elf_power
+                else:
+                    self.power[name] = DEFAULT_ATTACK_POWER
+        self.initial_elves = self.units.count(ELF)
 
     @classmethod
     def from_lines(cls, lines, **kwargs) -> "Board":
@@ -257,6 +389,19 @@ class Board():
                 grid[Pos(r, c)] = val
         return cls(grid, **kwargs)
 
+    @classmethod
+    def from_snapshot(cls, snap: Snapshot, elf_power=DEFAULT_ATTACK_POWER) -> "Board":
+        grid = defaultdict(lambda : ROCK, snap.cells)
+        board = cls(grid, elf_power=elf_power)
+        restore_hits(board, snap)
+        return board
+
+    def snapshot(self, rounds: int) -> Snapshot:
+        units = {pos: unit.name for pos, unit in self.units.at.items()}
+        return Snapshot(
+            rounds, dict(self.grid), 0, units, dict(self.hits), self.initial_elves
+        )
+
     def print(self, title="", overlay=None):
         if title:
             print(title)
@@ -270,6 +415,9 @@ class Board():
                 row.append(val)
             print("".join(row))
 
+    def neighbors(self, pos: Pos) -> List[Pos]:
+        return pos.neighbors()
+
     def move(self, pos, dest):
         # print(f"Move {self.grid[pos]} from {pos} to {dest}")
         assert self.grid[pos][0] in (ELF, GOBLIN)
@@ -277,6 +425,7 @@ class Board():
         assert dest in pos.neighbors()
         self.grid[dest] = self.grid[pos]
         self.grid[pos] = EMPTY
+        self.units.move(pos, dest)
 
     def attack(self, pos: Pos, target: Pos) -> bool:
         """Character at position 'pos' attacks character at position 'target'.
@@ -288,20 +437,23 @@ class Board():
         assert attacker[0] in (ELF, GOBLIN)
         assert defender[0] in (ELF, GOBLIN)
         self.hit_points[defender] -= self.power[attacker]
+        self.hits[defender] += 1
         # print(f"{attacker} attacks {defender} [{before} -> {self.hit_points[defender]}HP]")
         if self.hit_points[defender] < 1:
             # print(f"{attacker} kills {defender} ")
             self.grid[target] = EMPTY
+            self.units.remove(target)
             return True
         return False
         
 
     def locate(self, target):
-        result = []
-        for pos, val in self.grid.items():
-            if val[0] == target:
-                result.append(pos)
-        return result
+        """Return the sorted positions of all units of the given type."""
+        return self.units.locate(target)
+
+    def total_hit_points(self, kind: Cell) -> int:
+        """Return the total hit points of all units of the given type."""
+        return sum(self.hit_points[self.grid[pos]] for pos in self.locate(kind))
 
     def inrange(self, target):
         """Return positions of all locations in range of the
@@ -317,21 +469,21 @@ class Board():
         return result
 
     def distances(self, pos):
-        """Return dict mapping positions of all reachable locations to
-        the shortest distance to thatlocation.
+        """Return a map from the positions of all reachable locations to
+        the shortest distance to that location.  Unreachable locations
+        map to -1.  The map is reused, and is cleared by the next call.
         """
-        result = defaultdict(lambda: -1)
-        positions = [(pos, 0)]
-        visited = set()
-        while positions:
-            loc, dist = positions.pop(0)
-            if loc in visited:
-                continue
-            result[loc] = dist
-            visited.add(loc)
+        result = self._dists
+        result.clear()
+        result[pos] = 0
+        queue = deque([pos])
+        while queue:
+            loc = queue.popleft()
+            dist = result[loc] + 1
             for nayb in loc.neighbors():
-                if self.grid[nayb] == EMPTY and nayb not in visited:
-                    positions.append((nayb, dist+1))
+                if self.grid[nayb] == EMPTY and nayb not in result:
+                    result[nayb] = dist
+                    queue.append(nayb)
         return result
 
     def targets(self, pos):
@@ -347,8 +499,339 @@ class Board():
         result.sort()
         return result
 
+    def plan_move(self, pos: Pos) -> Optional[tuple[Pos, Pos]]:
+        """Find the nearest reachable square that is in range of a foe of the
+        unit at the given position.  Return that square and the first step
+        toward it, or None if no such square can be reached.
+
+        This is a single breadth-first search that stops at the first
+        distance layer containing a square in range.  Each layer is kept in
+        order of first step, so every square is first reached by way of the
+        first step that comes earliest in reading order.  The map from each
+        square reached to its first step is reused, and is cleared by the
+        next call.
+        """
+        foe = FOE[self.grid[pos][0]]
+        first = self._first
+        first.clear()
+        frontier = []
+        for nayb in sorted(pos.neighbors()):
+            if self.grid[nayb] == EMPTY:
+                first[nayb] = nayb
+                frontier.append(nayb)
+        while frontier:
+            goals = [
+                loc for loc in frontier
+                if any(self.grid[nayb][0] == foe for nayb in loc.neighbors())
+            ]
+            if goals:
+                goal = min(goals)
+                return goal, first[goal]
+            next_frontier = []
+            for loc in frontier:
+                for nayb in loc.neighbors():
+                    if self.grid[nayb] == EMPTY and nayb not in first:
+                        first[nayb] = first[loc]
+                        next_frontier.append(nayb)
+            frontier = next_frontier
+        return None
+
+
+class ArrayGrid():
+    """A rectangular map stored as a flat bytearray of cell symbols.
+
+    A cell is identified by the integer index row * width + col, so sorting
+    cell indices gives reading order.  The map is surrounded by a one-cell
+    border of 'fill' cells, so that neighbors of any interior cell can be
+    found by adding one of the precomputed offsets, without bounds checks.
+    """
+    cells: bytearray
+    width: int
+    height: int
+
+    def __init__(self, cells: bytearray, width: int):
+        assert len(cells) % width == 0
+        self.cells = cells
+        self.width = width
+        self.height = len(cells) // width
+        # Offsets to the neighbors of a cell, in reading order.
+        self.offsets = (-width, -1, 1, width)
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[str], fill: str, **kwargs) -> "ArrayGrid":
+        width = max(len(row) for row in rows) + 2
+        border = fill.encode() * width
+        cells = bytearray(border)
+        for row in rows:
+            cells += (fill + row.ljust(width - 2, fill) + fill).encode()
+        cells += border
+        return cls(cells, width, **kwargs)
+
+    def neighbors(self, idx: int) -> List[int]:
+        return [idx + offset for offset in self.offsets]
+
+    def print(self, title="", overlay=None):
+        if title:
+            print(title)
+        for r in range(1, self.height - 1):
+            start = r * self.width
+            row = [chr(val) for val in self.cells[start + 1:start + self.width - 1]]
+            if overlay:
+                for c in range(len(row)):
+                    row[c] = overlay.get(start + c + 1, row[c])
+            print("".join(row))
+
+
+class UnitTable():
+    """Struct-of-arrays storage for the units on a GridBoard.
+
+    A unit is identified by its index into the parallel columns.  Dead units
+    keep their row, with a position of -1.  This has the same interface as
+    UnitIndex, with unit ids in place of Unit records.
+    """
+    def __init__(self):
+        self.faction = array("b")   # ORD_ELF or ORD_GOBLIN
+        self.hp = array("i")
+        self.attack = array("i")
+        self.pos = array("i")
+        self.hits = array("i")      # number of hits taken
+        self.names = []
+        self.live = {ELF: 0, GOBLIN: 0}
+
+    def add(self, name: str, pos: int, hp: int, attack: int) -> int:
+        """Add a unit, and return its id."""
+        self.faction.append(ord(name[0]))
+        self.hp.append(hp)
+        self.attack.append(attack)
+        self.pos.append(pos)
+        self.hits.append(0)
+        self.names.append(name)
+        if pos >= 0:
+            self.live[name[0]] += 1
+        return len(self.names) - 1
+
+    def kill(self, uid: int) -> None:
+        self.pos[uid] = -1
+        self.live[chr(self.faction[uid])] -= 1
+
+    def position(self, uid: int) -> int:
+        return self.pos[uid]
+
+    def kind(self, uid: int) -> Cell:
+        return chr(self.faction[uid])
+
+    def alive(self, uid: int) -> bool:
+        return self.pos[uid] >= 0
+
+    def count(self, kind: Cell) -> int:
+        """Return the number of living units of the given type."""
+        return self.live[kind]
+
+    def locate(self, kind: Cell) -> List[int]:
+        """Return the sorted positions of all units of the given type."""
+        code = ord(kind)
+        faction = self.faction
+        return sorted(
+            pos for uid, pos in enumerate(self.pos) if pos >= 0 and faction[uid] == code
+        )
+
+    def in_order(self) -> List[int]:
+        """Return the ids of all living units, in reading order."""
+        return [uid for pos, uid in sorted(
+            (pos, uid) for uid, pos in enumerate(self.pos) if pos >= 0
+        )]
+
+
+class GridBoard(ArrayGrid):
+    """An array-backed replacement for Board.
+
+    Positions are cell indices into an ArrayGrid, and the grid holds only
+    the cell type.  A second layer, 'ids', holds the id of the unit in each
+    cell (or -1), and the units themselves are kept in a UnitTable.
+    """
+    def __init__(self, cells, width, names, elf_power=DEFAULT_ATTACK_POWER):
+        super().__init__(cells, width)
+        self.elf_power = elf_power
+        self._dists = array("i", [-1]) * len(cells)
+        self._reached = []
+        self._first = {}
+        self.rounds = 0     # full rounds completed by propagate()
+
+        self.ids = array("i", [-1]) * len(cells)
+        self.units = UnitTable()
+        for idx, name in sorted(names.items()):
+            power = elf_power if name[0] == ELF else DEFAULT_ATTACK_POWER
+            self.ids[idx] = self.units.add(name, idx, DEFAULT_HIT_POINTS, power)
+        self.initial_elves = self.units.count(ELF)
+
+    @classmethod
+    def from_lines(cls, lines, **kwargs) -> "GridBoard":
+        grid = ArrayGrid.from_rows(lines, ROCK)
+        names = {}
+        count = {ELF: 0, GOBLIN: 0}
+        for idx, val in enumerate(grid.cells):
+            val = chr(val)
+            if val in count:
+                count[val] += 1
+                names[idx] = f"{val}{count[val]}"
+        return cls(grid.cells, grid.width, names, **kwargs)
+
+    @classmethod
+    def from_snapshot(cls, snap: Snapshot, elf_power=DEFAULT_ATTACK_POWER) -> "GridBoard":
+        board = cls(bytearray(snap.cells), snap.width, snap.units, elf_power=elf_power)
+        board.initial_elves = snap.initial_elves
+        table = board.units
+        uids = {name: uid for uid, name in enumerate(table.names)}
+        for name, hits in snap.hits.items():
+            power = elf_power if name[0] == GOBLIN else DEFAULT_ATTACK_POWER
+            uid = uids.get(name)
+            if uid is None:
+                # Keep dead units, so that later snapshots know their hits.
+                uid = table.add(name, -1, 0, 0)
+            table.hits[uid] = hits
+            table.hp[uid] = DEFAULT_HIT_POINTS - hits * power
+        return board
+
+    def snapshot(self, rounds: int) -> Snapshot:
+        table = self.units
+        units = {pos: table.names[uid] for uid, pos in enumerate(table.pos) if pos >= 0}
+        hits = {table.names[uid]: hits for uid, hits in enumerate(table.hits) if hits}
+        return Snapshot(
+            rounds, bytes(self.cells), self.width, units, hits, self.initial_elves
+        )
+
+    def total_hit_points(self, kind: Cell) -> int:
+        """Return the total hit points of all units of the given type."""
+        table = self.units
+        code = ord(kind)
+        return sum(
+            table.hp[uid] for uid, pos in enumerate(table.pos)
+            if pos >= 0 and table.faction[uid] == code
+        )
+
+    def move(self, pos, dest):
+        cells = self.cells
+        assert cells[pos] in (ORD_ELF, ORD_GOBLIN)
+        assert cells[dest] == ORD_EMPTY
+        assert dest - pos in self.offsets
+        cells[dest] = cells[pos]
+        cells[pos] = ORD_EMPTY
+        uid = self.ids[dest] = self.ids[pos]
+        self.ids[pos] = -1
+        self.units.pos[uid] = dest
+
+    def attack(self, pos: int, target: int) -> bool:
+        """Character at position 'pos' attacks character at position 'target'.
+        Return True if target is killed, else False.
+        """
+        table = self.units
+        defender = self.ids[target]
+        table.hp[defender] -= table.attack[self.ids[pos]]
+        table.hits[defender] += 1
+        if table.hp[defender] < 1:
+            self.cells[target] = ORD_EMPTY
+            self.ids[target] = -1
+            table.kill(defender)
+            return True
+        return False
+
+    def locate(self, target):
+        """Return the sorted positions of all units of the given type."""
+        return self.units.locate(target)
+
+    def inrange(self, target):
+        """Return positions of all locations in range of the
+        given target type (ELF or GOBLIN).
+        """
+        cells = self.cells
+        positions = set()
+        for pos in self.locate(target):
+            for offset in self.offsets:
+                if cells[pos + offset] == ORD_EMPTY:
+                    positions.add(pos + offset)
+        return sorted(positions)
+
+    def distances(self, pos):
+        """Return an array of the shortest distance from the given position
+        to every cell, or -1 for cells that can't be reached.  The array is
+        reused, and is cleared by the next call.
+        """
+        cells = self.cells
+        offsets = self.offsets
+        result = self._dists
+        for loc in self._reached:
+            result[loc] = -1
+        reached = self._reached = [pos]
+        result[pos] = 0
+        queue = deque([pos])
+        while queue:
+            loc = queue.popleft()
+            dist = result[loc] + 1
+            for offset in offsets:
+                nayb = loc + offset
+                if cells[nayb] == ORD_EMPTY and result[nayb] < 0:
+                    result[nayb] = dist
+                    reached.append(nayb)
+                    queue.append(nayb)
+        return result
+
+    def targets(self, pos):
+        """Return sorted list of foes that can be attacked by the elf or
+        goblin at the given location.
+        """
+        cells = self.cells
+        ids = self.ids
+        hp = self.units.hp
+        foe = ORD_FOE[cells[pos]]
+        result = []
+        for offset in self.offsets:
+            nayb = pos + offset
+            if cells[nayb] == foe:
+                result.append((hp[ids[nayb]], nayb))
+        result.sort()
+        return result
 
-def first_step(start, goal, dists):
+    def plan_move(self, pos: int) -> Optional[tuple[int, int]]:
+        """Find the nearest reachable square that is in range of a foe of the
+        unit at the given position.  Return that square and the first step
+        toward it, or None if no such square can be reached.
+        (See Board.plan_move.)
+        """
+        cells = self.cells
+        offsets = self.offsets
+        width = self.width
+        foe = ORD_FOE[cells[pos]]
+        first = self._first
+        first.clear()
+        frontier = []
+        for offset in offsets:
+            nayb = pos + offset
+            if cells[nayb] == ORD_EMPTY:
+                first[nayb] = nayb
+                frontier.append(nayb)
+        while frontier:
+            goal = -1
+            for loc in frontier:
+                if (goal < 0 or loc < goal) and (
+                    cells[loc - width] == foe or cells[loc - 1] == foe or
+                    cells[loc + 1] == foe or cells[loc + width] == foe
+                ):
+                    goal = loc
+            if goal >= 0:
+                return goal, first[goal]
+            next_frontier = []
+            for loc in frontier:
+                step = first[loc]
+                for offset in offsets:
+                    nayb = loc + offset
+                    if cells[nayb] == ORD_EMPTY and nayb not in first:
+                        first[nayb] = step
+                        next_frontier.append(nayb)
+            frontier = next_frontier
+        return None
+
+
+def first_step(board, start, goal, dists):
     """Return list of the shortest paths from the start position to the goal.
     The distance map for the start position must be provided.
     """
@@ -360,8 +843,8 @@ def first_step(start, goal, dists):
         dist -= 1
         next_step = []
         for pos in frontier:
-            for nayb in pos.neighbors():
-                if dists.get(nayb, -1) == dist:
+            for nayb in board.neighbors(pos):
+                if dists[nayb] == dist:
                     # print(f"... pos: {pos}  nayb: {nayb}")
                     next_step.append(nayb)
         frontier = next_step
@@ -369,46 +852,145 @@ def first_step(start, goal, dists):
     frontier.sort()
     return frontier[0]
 
-def propagate(board, attack: bool = True) -> int:
+class Profile():
+    """Instrumentation for a single battle.
+
+    attach() wraps the board's targets(), plan_move(), move() and attack()
+    methods to count calls and time them, and detach() removes the
+    wrappers again.  propagate() calls start_round() and start_turn() to
+    count the turns taken in each round.  Nothing is wrapped or called
+    unless a Profile is passed to propagate(), so there is no cost
+    otherwise.
+    """
+    PHASES = ("targets", "plan_move", "move", "attack")
+
+    def __init__(self):
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.turns = []     # units processed in each round
+        self.expanded = 0   # squares reached while planning moves
+
+    def attach(self, board) -> None:
+        for phase in self.PHASES:
+            setattr(board, phase, self._timed(phase, getattr(board, phase)))
+
+        plan_move = board.plan_move
+
+        def planned(*args):
+            result = plan_move(*args)
+            self.expanded += len(board._first)
+            return result
+
+        board.plan_move = planned
+
+    def detach(self, board) -> None:
+        for phase in self.PHASES:
+            delattr(board, phase)
+
+    def start_round(self) -> None:
+        self.turns.append(0)
+
+    def start_turn(self) -> None:
+        self.turns[-1] += 1
+
+    def _timed(self, phase, method):
+        def timed(*args):
+            t0 = time.perf_counter()
+            result = method(*args)
+            self.seconds[phase] += time.perf_counter() - t0
+            self.calls[phase] += 1
+            return result
+        return timed
+
+    def as_dict(self) -> dict:
+        return {
+            "phases": {
+                phase: {"calls": self.calls[phase], "seconds": self.seconds[phase]}
+                for phase in self.PHASES
+            },
+            "rounds": len(self.turns),
+            "turns_per_round": self.turns,
+            "squares_expanded": self.expanded,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    def print(self, title="") -> None:
+        stats = self.as_dict()
+        if title:
+            print(title)
+        print(f"{'phase':<10s} {'calls':>8s} {'total (ms)':>12s} {'per call (us)':>14s}")
+        for phase, data in stats["phases"].items():
+            calls, seconds = data["calls"], data["seconds"]
+            per_call = 1e6 * seconds / calls if calls else 0.0
+            print(f"{phase:<10s} {calls:>8d} {1000 * seconds:>12.2f} {per_call:>14.1f}")
+        turns = sum(self.turns)
+        print(f"rounds: {stats['rounds']}  turns: {turns}  "
+              f"squares expanded: {stats['squares_expanded']}")
+
+
+def propagate(
+    board,
+    attack: bool = True,
+    stop_on_elf_death: bool = False,
+    start_round: int = 0,
+    snapshots: Optional[list] = None,
+    profile: Optional[Profile] = None,
+) -> int:
     """Play the game.  Return when one side has won, or no further
     progress can be made.  The board is updated in place.
+
+    If stop_on_elf_death is True, the game is abandoned as soon as an elf
+    is killed, and a score of 0 is returned, with victory False.
+
+    A game resumed from a snapshot must be given the number of rounds
+    already completed as start_round.  The number of full rounds completed
+    by the end of the game is left in board.rounds.  If a snapshots list
+    is given, a snapshot of the board is taken at the start of every round.
+    It replaces the last one in the list if that is valid for the same elf
+    powers, and is appended otherwise.
+    If a Profile is given, it is attached to the board to record where the
+    time goes, and detached again when the game ends.
     """
-    rounds = 0
-    initial_elves = board.locate(ELF)
+    if profile is not None:
+        profile.attach(board)
+    rounds = start_round
+    initial_elves = board.initial_elves
 
     # board.print(title=f"Initially:")
     while True:
+        if snapshots is not None:
+            snap = board.snapshot(rounds)
+            if snapshots and snapshots[-1].fork_key() == snap.fork_key():
+                snapshots[-1] = snap
+            else:
+                snapshots.append(snap)
         rounds += 1
-        elves = board.locate(ELF)
-        goblins = board.locate(GOBLIN)
-        # print(f"\nRound {rounds} :: Elves: {len(elves)}  Goblins: {len(goblins)}")
+        if profile is not None:
+            profile.start_round()
+        # print(f"\nRound {rounds} :: Elves: {board.units.count(ELF)}  Goblins: {board.units.count(GOBLIN)}")
 
         action = 0
         incomplete_loop = False
 
-        units = elves + goblins
-        units.sort()
-
-        for pos in units:
-            name = board.grid[pos]
-            if name == EMPTY:
+        units = board.units
+        for unit in units.in_order():
+            if not units.alive(unit):
                 continue
-            other = FOE[board.grid[pos][0]]
-            if not board.locate(other):
+            if profile is not None:
+                profile.start_turn()
+            pos = units.position(unit)
+            other = FOE[units.kind(unit)]
+            if not units.count(other):
                 incomplete_loop = True
                 break
             foes = board.targets(pos)
             if not foes:
                 # Move
-                inrange = board.inrange(other)
-                dists = board.distances(pos)
-                reachable = {pos: dist for pos, dist in dists.items() if pos in inrange}
-                if reachable:
-                    mindist = min(reachable.values())
-                    nearest = [pos for pos, dist in reachable.items() if dist == mindist]
-                    nearest.sort()
-                    goal = nearest[0]
-                    step = first_step(pos, goal, dists)
+                plan = board.plan_move(pos)
+                if plan:
+                    _, step = plan
                     board.move(pos, step)
                     pos = step
                     action += 1
@@ -417,25 +999,35 @@ def propagate(board, attack: bool = True) -> int:
                 if attack:
                     # Attack!
                     _, foe = foes[0]
-                    board.attack(pos, foe)
+                    killed = board.attack(pos, foe)
                     action += 1
+                    if killed and stop_on_elf_death and other == ELF:
+                        casualties = initial_elves - board.units.count(ELF)
+                        print(f"Elf killed in round {rounds}")
+                        board.rounds = rounds - 1
+                        if profile is not None:
+                            profile.detach(board)
+                        return 0, False, casualties
 
         # board.print(title=f"After {rounds} rounds:")
         if incomplete_loop or not action:
             rounds -= 1
             break
+    board.rounds = rounds
+    if profile is not None:
+        profile.detach(board)
 
     elves = board.locate(ELF)
     goblins = board.locate(GOBLIN)
-    casualties  = len(initial_elves) - len(elves)
+    casualties  = initial_elves - len(elves)
     # for pos in elves + goblins:
     #     character = board.grid[pos]
     #     print(f"{character} has {board.hit_points[character]} HP")
     if elves:
-        total_hit_points = sum([board.hit_points[board.grid[elf]] for elf in elves])
+        total_hit_points = board.total_hit_points(ELF)
         victory = True
     elif goblins:
-        total_hit_points = sum([board.hit_points[board.grid[gob]] for gob in goblins])
+        total_hit_points = board.total_hit_points(GOBLIN)
         victory = False
     score = rounds * total_hit_points
     print(f"Final score: {score} <-- {rounds} rounds, {total_hit_points} HP remaining") 
@@ -469,7 +1061,7 @@ def check(lines):
 
     elf1 = elves[0]
     dists = board.distances(elf1)
-    reachable = {pos: dist for pos, dist in dists.items() if pos in inrange}
+    reachable = {pos: dists[pos] for pos in inrange if dists[pos] >= 0}
     symbols = {pos: "@" for pos in reachable}
     board.print(title="Reachable:", overlay=symbols)
 
@@ -485,33 +1077,215 @@ def check(lines):
     symbols = {goal: "+"}
     board.print(title="Chosen:", overlay=symbols)
 
-    step = first_step(elf1, goal, dists)
+    step = first_step(board, elf1, goal, dists)
     board.move(elf1, step)
     board.print(title="Step:")
 
 
-def solve2(lines: Lines) -> int:
-    """Solve the problem."""
-    victory = False
-    casualties = -1
-    power = DEFAULT_ATTACK_POWER + 1
-    while not victory or casualties != 0:
-        board = Board.from_lines(lines, elf_power=power)
-        score, victory, casualties = propagate(board)
-        if victory:
-            if not casualties:
-                print(f"ELVES WIN!  power={power}, score={score}")
-            else:
-                print(f"elves win.  power={power}, score={score}, casualties={casualties}")
+class Battles():
+    """Plays battles for the same cave with different elf attack powers.
+
+    If fork is True, each new battle is resumed from the latest snapshot of
+    an earlier battle that is still valid at the new power, rather than
+    from round 1.  Of the snapshots taken at the start of every round, only
+    the latest for each set of powers it is valid for is kept.
+    """
+    def __init__(self, lines: Lines, board_cls: type = GridBoard, fork: bool = False):
+        self.lines = lines
+        self.board_cls = board_cls
+        self.fork = fork
+        self.history = []   # list of kept snapshots of each battle played
+        self.rounds_played = 0
+        self.rounds_saved = 0
+
+    def fork_point(self, power: int) -> Optional[Snapshot]:
+        """Return the latest recorded snapshot that is valid for the given
+        elf power, or None.
+        """
+        best = None
+        for snapshots in self.history:
+            # Once a battle diverges, all its later snapshots are invalid.
+            for snap in reversed(snapshots):
+                if best and snap.rounds <= best.rounds:
+                    break
+                if snap.valid_for(power):
+                    best = snap
+                    break
+        return best
+
+    def play(self, power: int) -> Optional[int]:
+        """Play the game with the given elf attack power.  Return the score
+        if the elves win without losing anyone, else None.  The game is
+        abandoned as soon as an elf dies.
+        """
+        snap = self.fork_point(power) if self.fork else None
+        if snap:
+            board = self.board_cls.from_snapshot(snap, elf_power=power)
+            start_round = snap.rounds
+            self.rounds_saved += start_round
         else:
-            print(f"goblins win.  power={power}, score={score}")
-        power += 1
-    return score
+            board = self.board_cls.from_lines(self.lines, elf_power=power)
+            start_round = 0
+
+        snapshots = [] if self.fork else None
+        score, victory, casualties = propagate(
+            board, stop_on_elf_death=True, start_round=start_round,
+            snapshots=snapshots
+        )
+        if snapshots is not None:
+            self.history.append(snapshots)
+        # Count the last, unfinished, round too.
+        self.rounds_played += board.rounds + 1 - start_round
+
+        if victory and not casualties:
+            print(f"ELVES WIN!  power={power}, score={score}")
+            return score
+        print(f"elves lose.  power={power}")
+        return None
+
+    def report(self) -> None:
+        total = self.rounds_played + self.rounds_saved
+        if total:
+            print(f"Rounds played: {self.rounds_played}  "
+                  f"saved by forking: {self.rounds_saved} "
+                  f"({100 * self.rounds_saved / total:.0f}%)")
+
+
+def elves_survive(lines: Lines, power: int, board_cls: type = GridBoard) -> Optional[int]:
+    """Play the game with the given elf attack power.  Return the score if
+    the elves win without losing anyone, else None.  The game is abandoned
+    as soon as an elf dies.
+    """
+    return Battles(lines, board_cls).play(power)
+
 
-def solve(lines: Lines) -> int:
+def sweep_power(lines: Lines, board_cls: type = GridBoard, fork: bool = False) -> int:
+    """Return the score for the lowest elf attack power that lets the elves
+    win without losses, trying each power in turn.
+    """
+    battles = Battles(lines, board_cls, fork=fork)
+    for power in range(DEFAULT_ATTACK_POWER + 1, MAX_ELF_POWER + 1):
+        score = battles.play(power)
+        if score is not None:
+            battles.report()
+            return score
+    raise ValueError("Elves can't win without losses at any power")
+
+
+def search_power(
+    lines: Lines,
+    board_cls: type = GridBoard,
+    fork: bool = False,
+    battles: Optional[Battles] = None
+) -> int:
+    """Return the score for the lowest elf attack power that lets the elves
+    win without losses.
+
+    The power is doubled until the elves win, and the lowest winning
+    power is then found by bisection.  This assumes that the outcome is
+    monotone in power.  If any of the powers tried contradicts that, we
+    fall back to sweep_power().
+
+    A Battles instance may be given, to collect statistics on the games.
+    """
+    battles = battles or Battles(lines, board_cls, fork=fork)
+    results = {}
+
+    def outcome(power):
+        results[power] = battles.play(power)
+        return results[power]
+
+    # Elves are known to lose at the default power.
+    lo, step = DEFAULT_ATTACK_POWER, 1
+    hi = lo + step
+    while outcome(hi) is None:
+        if hi == MAX_ELF_POWER:
+            raise ValueError("Elves can't win without losses at any power")
+        lo, step = hi, step * 2
+        hi = min(lo + step, MAX_ELF_POWER)
+
+    # Now lo loses and hi wins.
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if outcome(mid) is None:
+            lo = mid
+        else:
+            hi = mid
+
+    monotone = all(
+        (score is not None) == (power >= hi) for power, score in results.items()
+    )
+    if not monotone:
+        print(f"Outcome is not monotone in power: {sorted(results.items())}")
+        return sweep_power(lines, board_cls, fork=fork)
+    battles.report()
+    return results[hi]
+
+
+def _power_outcome(args) -> tuple[int, Optional[int]]:
+    lines, power, board_cls = args
+    return power, elves_survive(lines, power, board_cls)
+
+
+def parallel_power(
+    lines: Lines,
+    workers: int = 0,
+    window: int = 0,
+    board_cls: type = GridBoard
+) -> int:
+    """Return the score for the lowest elf attack power that lets the elves
+    win without losses, playing several powers at once in a process pool.
+
+    Powers are tried in windows of consecutive values.  As soon as a
+    winning power is found, and every lower power in the window has lost,
+    the pool is terminated, abandoning any games still in progress.
+    """
+    workers = workers or os.cpu_count() or 1
+    window = window or workers
+    start = DEFAULT_ATTACK_POWER + 1
+    with multiprocessing.Pool(workers) as pool:
+        while start <= MAX_ELF_POWER:
+            powers = range(start, min(start + window, MAX_ELF_POWER + 1))
+            results = {}
+            tasks = [(lines, power, board_cls) for power in powers]
+            for power, score in pool.imap_unordered(_power_outcome, tasks):
+                results[power] = score
+                winners = [p for p, s in results.items() if s is not None]
+                if winners:
+                    best = min(winners)
+                    if all(p in results for p in range(start, best)):
+                        # Leaving the with block terminates the pool.
+                        return results[best]
+            start += window
+    raise ValueError("Elves can't win without losses at any power")
+
+
+def solve2(
+    lines: Lines,
+    board_cls: type = GridBoard,
+    search: bool = True,
+    workers: int = 0,
+    fork: bool = False
+) -> int:
+    """Solve the problem.  If workers is given, powers are tried in parallel
+    with that many processes.  Otherwise, if fork is True, each battle is
+    resumed from an earlier one where possible.  Forking copies the whole
+    board at the start of every round, so it is off by default.
+    """
+    if workers:
+        return parallel_power(lines, workers=workers, board_cls=board_cls)
+    if search:
+        return search_power(lines, board_cls, fork=fork)
+    return sweep_power(lines, board_cls, fork=fork)
+
+def solve(
+    lines: Lines,
+    board_cls: type = GridBoard,
+    profile: Optional[Profile] = None
+) -> int:
     """Solve the problem."""
-    board = Board.from_lines(lines)
-    score, _, _ = propagate(board)
+    board = board_cls.from_lines(lines)
+    score, _, _ = propagate(board, profile=profile)
     return score
 
 
@@ -530,11 +1304,12 @@ def example1() -> None:
     check2(lines)
 
     for text, expected in SAMPLE_CASES:
-        print("- "*32)
-        lines = load_text(text)
-        result = solve(lines)
-        print(f"'{text}' -> {result} (expected {expected})")
-        assert result == expected
+        for board_cls in (Board, GridBoard):
+            print("- "*32)
+            lines = load_text(text)
+            result = solve(lines, board_cls=board_cls)
+            print(f"'{text}' -> {result} (expected {expected})")
+            assert result == expected
 
 def part1(lines: Lines) -> None:
     print("PART 1:")
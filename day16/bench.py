@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+#
+#  Advent of Code 2018 - Day 16 benchmarks
+#
+import random
+import time
+
+from day16 import (
+    Device, BatchDevice, Trace, ENGINES, random_program, INPUTFILE, load_input, parse_sections, resolve_opcodes,
+    translate_program,
+)
+
+# Sum 1..N, with N in register 2 and the instruction pointer bound to
+# register 5.  The result is left in register 0.
+COUNTING_LOOP = [
+    "#ip 5",
+    "seti 0 0 1",
+    "addi 1 1 1",
+    "addr 0 1 0",
+    "gtrr 2 1 3",
+    "addr 5 3 5",
+    "seti 99 0 5",
+    "seti 0 0 5",
+]
+
+
+def input_program() -> list:
+    parts = parse_sections(load_input(INPUTFILE))
+    return translate_program(parts[-1], resolve_opcodes(parts[:-1]))
+
+
+def count_steps(dev: Device) -> int:
+    """Return the number of instructions executed by a run of the device.
+    The device is left in its final state.
+    """
+    steps = 0
+    while 0 <= dev.pc < len(dev.program):
+        dev.step()
+        steps += 1
+    return steps
+
+
+def timed_run(make_device, compiled: bool, repeat: int, warm: bool = False) -> float:
+    """Return the best time for a run of a fresh device.  If warm is True,
+    the same device is rerun, so that compiled blocks are reused.
+    """
+    best = None
+    dev = make_device()
+    reg = list(dev.reg)
+    if warm:
+        dev.run(compiled=compiled)
+    for _ in range(repeat):
+        if warm:
+            dev.reg[:] = reg
+            dev.pc = 0
+        else:
+            dev = make_device()
+        t0 = time.perf_counter()
+        dev.run(compiled=compiled)
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_engines(repeat: int = 5) -> None:
+    """Report instructions per second for the interpreter and the compiler,
+    on the puzzle input program and on a counting loop.
+    """
+    prog = input_program()
+    cases = [
+        ("input program", lambda: Device(prog=prog)),
+        ("counting loop", lambda: Device(reg=[0, 0, 100000, 0, 0, 0]).load_prog(COUNTING_LOOP)),
+    ]
+    print("ENGINES:")
+    print(f"{'program':<16s} {'instructions':>12s} {'interpreted/s':>14s} "
+          f"{'compiled/s':>12s} {'(cached)':>10s}")
+    for name, make_device in cases:
+        steps = count_steps(make_device())
+        rates = [
+            steps / timed_run(make_device, compiled, repeat, warm)
+            for compiled, warm in ((False, False), (True, False), (True, True))
+        ]
+        print(f"{name:<16s} {steps:>12d} {rates[0]:>14.3g} {rates[1]:>12.3g} {rates[2]:>10.3g}")
+    print("= " * 32)
+
+
+# Sum of the divisors of N, with N in register 4.
+DIVISOR_SUM = [
+    "#ip 5",
+    "seti 1 0 1",
+    "seti 1 0 2",
+    "mulr 1 2 3",
+    "eqrr 3 4 3",
+    "addr 3 5 5",
+    "addi 5 1 5",
+    "addr 1 0 0",
+    "addi 2 1 2",
+    "gtrr 2 4 3",
+    "addr 5 3 5",
+    "seti 1 0 5",
+    "addi 1 1 1",
+    "gtrr 1 4 3",
+    "addr 3 5 5",
+    "seti 0 0 5",
+    "seti 99 0 5",
+]
+
+
+def bench_shortcuts(sizes=(100, 300, 1000, 10000, 100000)) -> None:
+    """Time the divisor sum program with and without loop shortcuts.  The
+    interpreter is only run on the smaller inputs.
+    """
+    print("SHORTCUTS (divisor sum):")
+    print(f"{'N':>8s} {'result':>10s} {'interpreted (s)':>16s} {'shortcuts (s)':>14s}")
+    for n in sizes:
+        times = []
+        for shortcuts in (False, True):
+            if not shortcuts and n > 300:
+                times.append(None)
+                continue
+            dev = Device(reg=[0, 0, 0, 0, n, 0]).load_prog(DIVISOR_SUM)
+            t0 = time.perf_counter()
+            dev.run(shortcuts=shortcuts)
+            times.append(time.perf_counter() - t0)
+        plain = f"{times[0]:>16.3f}" if times[0] is not None else f"{'-':>16s}"
+        print(f"{n:>8d} {dev.reg[0]:>10d} {plain} {times[1]:>14.3f}")
+    print("= " * 32)
+
+
+def bench_batch(lanes=(1, 10, 100, 1000)) -> None:
+    """Time the divisor sum program over many values of N, one device at
+    a time and in lockstep with BatchDevice.
+    """
+    print("BATCH (divisor sum, N = 1..30 repeated):")
+    print(f"{'lanes':>6s} {'devices (s)':>12s} {'batch (s)':>10s}")
+    for count in lanes:
+        regs = [[0, 0, 0, 0, 1 + n % 30, 0] for n in range(count)]
+        t0 = time.perf_counter()
+        for reg in regs:
+            Device(reg=reg).load_prog(DIVISOR_SUM).run()
+        single = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        BatchDevice.from_lines(DIVISOR_SUM, regs).run()
+        batch = time.perf_counter() - t0
+        print(f"{count:>6d} {single:>12.3f} {batch:>10.3f}")
+    print("= " * 32)
+
+
+def bench_fuzz(
+    seed: int = 0,
+    programs: int = 50,
+    length: int = 200,
+    lanes: int = 20
+) -> None:
+    """Run random programs from random registers through every engine, and
+    report instructions per second for each.  Each run uses a fresh Device,
+    so the compiled and shortcut times include their setup.  Raise
+    ValueError if any engine disagrees with the first one, so that a
+    speedup can't quietly change the results.
+    """
+    rng = random.Random(seed)
+    for ip in (None, 3):
+        cases = []
+        for _ in range(programs):
+            prog = random_program(rng, length, ip=ip)
+            regs = [[rng.randrange(-8, 32) for _ in range(4)] for _ in range(lanes)]
+            cases.append((prog, regs))
+
+        steps = 0
+        for prog, regs in cases:
+            for reg in regs:
+                trace = Trace()
+                Device(prog=prog, reg=reg).run(trace=trace)
+                steps += trace.steps
+
+        print(f"FUZZ ({programs} programs x {lanes} registers, length {length}, ip={ip}):")
+        print(f"{'engine':<12s} {'seconds':>9s} {'instructions/s':>15s}")
+        expected = None
+        for name, engine in ENGINES.items():
+            results = []
+            t0 = time.perf_counter()
+            for prog, regs in cases:
+                for reg in regs:
+                    dev = Device(prog=prog, reg=reg)
+                    engine(dev)
+                    results.append((dev.reg, dev.pc))
+            elapsed = time.perf_counter() - t0
+            if expected is None:
+                expected = results
+            elif results != expected:
+                raise ValueError(f"Engine '{name}' changed the results")
+            print(f"{name:<12s} {elapsed:>9.3f} {steps / elapsed:>15.3g}")
+        print("= " * 32)
+
+
+def trace_programs() -> None:
+    """Print a trace report for each benchmark program, to show where the
+    time goes.
+    """
+    prog = input_program()
+    cases = [
+        ("input program", Device(prog=prog)),
+        ("counting loop", Device(reg=[0, 0, 1000, 0, 0, 0]).load_prog(COUNTING_LOOP)),
+    ]
+    for name, dev in cases:
+        trace = Trace()
+        dev.run(trace=trace)
+        print(f"TRACE ({name}):")
+        print(trace.report())
+        print("= " * 32)
+
+
+if __name__ == "__main__":
+    bench_engines()
+    bench_shortcuts()
+    bench_batch()
+    bench_fuzz()
+    trace_programs()
@@ -2,13 +2,23 @@
 #
 #  Advent of Code 2018 - Day 16
 #
-from typing import Sequence, Union, Optional, Any, List, Dict
+from typing import (
+    Sequence, Union, Optional, Any, List, Dict, Callable, Tuple, Iterable, Iterator
+)
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, Counter
 from dataclasses import dataclass
+from array import array
 import math
+import random
 import re
 
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only used to match samples in bulk.
+    np = None
+
 INPUTFILE = "input.txt"
 
 SAMPLE_CASES = [
@@ -77,6 +87,57 @@ OPCODES: List[Opcode] = [
     "eqrr",
 ]
 
+Operation = Callable[[List[int], int, int], int]
+
+# Each operation returns the value to store in register C, given the
+# registers and the A and B inputs.
+OPERATIONS: Dict[Opcode, Operation] = {
+    "addr": lambda reg, a, b: reg[a] + reg[b],
+    "addi": lambda reg, a, b: reg[a] + b,
+    "mulr": lambda reg, a, b: reg[a] * reg[b],
+    "muli": lambda reg, a, b: reg[a] * b,
+    "banr": lambda reg, a, b: reg[a] & reg[b],
+    "bani": lambda reg, a, b: reg[a] & b,
+    "borr": lambda reg, a, b: reg[a] | reg[b],
+    "bori": lambda reg, a, b: reg[a] | b,
+    "setr": lambda reg, a, b: reg[a],
+    "seti": lambda reg, a, b: a,
+    "gtir": lambda reg, a, b: int(a > reg[b]),
+    "gtri": lambda reg, a, b: int(reg[a] > b),
+    "gtrr": lambda reg, a, b: int(reg[a] > reg[b]),
+    "eqir": lambda reg, a, b: int(a == reg[b]),
+    "eqri": lambda reg, a, b: int(reg[a] == b),
+    "eqrr": lambda reg, a, b: int(reg[a] == reg[b]),
+}
+
+# Dispatch table, indexed by position in OPCODES.
+HANDLERS: List[Operation] = [OPERATIONS[op] for op in OPCODES]
+OPCODE_INDEX: Dict[Opcode, int] = {op: idx for idx, op in enumerate(OPCODES)}
+
+# A decoded instruction: (opcode index, A, B, C)
+Decoded = Tuple[int, int, int, int]
+
+# Python expression for each operation, used when compiling programs, and
+# whether its A and B inputs are registers (True) or values (False).
+SOURCE: Dict[Opcode, Tuple[str, bool, bool]] = {
+    "addr": ("{a} + {b}", True, True),
+    "addi": ("{a} + {b}", True, False),
+    "mulr": ("{a} * {b}", True, True),
+    "muli": ("{a} * {b}", True, False),
+    "banr": ("{a} & {b}", True, True),
+    "bani": ("{a} & {b}", True, False),
+    "borr": ("{a} | {b}", True, True),
+    "bori": ("{a} | {b}", True, False),
+    "setr": ("{a}", True, False),
+    "seti": ("{a}", False, False),
+    "gtir": ("(1 if {a} > {b} else 0)", False, True),
+    "gtri": ("(1 if {a} > {b} else 0)", True, False),
+    "gtrr": ("(1 if {a} > {b} else 0)", True, True),
+    "eqir": ("(1 if {a} == {b} else 0)", False, True),
+    "eqri": ("(1 if {a} == {b} else 0)", True, False),
+    "eqrr": ("(1 if {a} == {b} else 0)", True, True),
+}
+
 @dataclass
 class Instruction():
     """A single instruction for the computing device."""
@@ -86,74 +147,721 @@ class Instruction():
     C: Union[str, int]  # output
 
 
+class Program():
+    """A program in packed form: a flat array('i') holding the opcode index
+    and the A, B and C values of each instruction in turn.
+    """
+    code: array
+    ip: Optional[int]
+
+    def __init__(self, code: Optional[array] = None, ip: Optional[int] = None):
+        self.code = code if code is not None else array("i")
+        self.ip = ip
+
+    def __len__(self) -> int:
+        return len(self.code) // 4
+
+    def __getitem__(self, pc: int) -> Decoded:
+        return tuple(self.code[4 * pc:4 * pc + 4])
+
+    @classmethod
+    def from_instructions(
+        cls,
+        prog: Sequence[Instruction],
+        ip: Optional[int] = None
+    ) -> "Program":
+        code = array("i")
+        for ins in prog:
+            if ins.op not in OPCODE_INDEX:
+                raise ValueError(f"Unrecognized opcode '{ins.op}'")
+            code.extend((OPCODE_INDEX[ins.op], ins.A, ins.B, ins.C))
+        return cls(code, ip)
+
+    @classmethod
+    def from_lines(
+        cls,
+        lines: Iterable[str],
+        strcode: Optional[Dict[int, Opcode]] = None
+    ) -> "Program":
+        """Parse a program, one instruction per line.  Each line holds an
+        opcode name and the A, B and C values, optionally separated by
+        commas.  If strcode is given, opcodes are given as numbers instead,
+        and strcode maps them to names.  An "#ip N" line binds the
+        instruction pointer to register N.
+        """
+        program = cls()
+        code = program.code
+        for line in lines:
+            words = line.replace(",", " ").split()
+            if not words:
+                continue
+            if words[0] == "#ip":
+                program.ip = int(words[1])
+                continue
+            op = strcode[int(words[0])] if strcode else words[0]
+            if op not in OPCODE_INDEX:
+                raise ValueError(f"Unrecognized opcode '{op}'")
+            code.extend((OPCODE_INDEX[op], int(words[1]), int(words[2]), int(words[3])))
+        return program
+
+    def to_lines(self, numcode: Optional[Dict[Opcode, int]] = None) -> list[str]:
+        """Return the text of the program, in the format read by from_lines().
+        If numcode is given, opcodes are written as numbers, using numcode
+        to map names to numbers.
+        """
+        lines = []
+        if self.ip is not None:
+            lines.append(f"#ip {self.ip}")
+        code = self.code
+        for i in range(0, len(code), 4):
+            op = OPCODES[code[i]]
+            if numcode:
+                op = numcode[op]
+            lines.append(f"{op} {code[i + 1]} {code[i + 2]} {code[i + 3]}")
+        return lines
+
+    def instructions(self) -> list[Instruction]:
+        code = self.code
+        return [
+            Instruction(OPCODES[code[i]], code[i + 1], code[i + 2], code[i + 3])
+            for i in range(0, len(code), 4)
+        ]
+
+
 class Device():
-    """A computing device with four numeric registers and 16 instructions."""
+    """A computing device with four numeric registers and 16 instructions.
+
+    The program is held in packed form, as a Program, and executed through
+    a dispatch table indexed by opcode number.
+
+    The instruction pointer may be bound to a register, with an "#ip N"
+    line at the start of the program.  The register then holds the pc
+    while each instruction executes, and the pc is read back from it
+    afterwards, so that programs can jump.
+    """
     def __init__(
         self,
-        prog: Optional[list[Instruction]] = None,
-        reg: Optional[list[int]] = None
+        prog: Union[Program, Sequence[Instruction], None] = None,
+        reg: Optional[list[int]] = None,
+        ip: Optional[int] = None
     ):
-        self.prog = []
         self.reg = [0, 0, 0, 0]
-        if prog:
-            self.prog = list(prog)
         if reg:
             self.reg = list(reg)
+        if isinstance(prog, Program):
+            self.program = prog
+        else:
+            self.program = Program.from_instructions(prog or [])
+        self.ip = ip if ip is not None else self.program.ip
+        self._blocks = {}
+        self._idioms = None
         self.pc = 0
 
+    @property
+    def prog(self) -> list[Instruction]:
+        return self.program.instructions()
+
     def load_prog(self, lines: list[str]):
-        self.prog = []
-        for line in lines:
-            line = line.replace(",", " ")
-            op, a, b, c, = line.split()
-            self.prog.append(Instruction(op, int(a), int(b), int(c)))
+        self.program = Program.from_lines(lines)
+        if self.program.ip is not None:
+            self.ip = self.program.ip
+        self._blocks = {}
+        self._idioms = None
         self.pc = 0
         return self
 
-    def run(self):
-        while 0<= self.pc < len(self.prog):
-            self.step()
+    def run(
+        self,
+        compiled: bool = False,
+        trace: Optional["Trace"] = None,
+        shortcuts: bool = False
+    ):
+        """Run the program until the pc leaves it.  If compiled is True,
+        the program is compiled to Python functions, one for each basic
+        block, rather than interpreted.  If a Trace is given, the program
+        is interpreted by run_traced() instead, and the trace is filled in.
+        If shortcuts is True, recognized loops are replaced by closed-form
+        computations; see run_shortcuts().
+        """
+        if trace is not None:
+            self.run_traced(trace)
+        elif shortcuts:
+            self.run_shortcuts()
+        elif compiled:
+            self.run_compiled()
+        elif self.ip is not None:
+            self.run_jumps()
+        elif 0 <= self.pc < len(self.program):
+            reg = self.reg
+            handlers = HANDLERS
+            words = iter(self.program.code[4 * self.pc:])
+            for op, a, b, c in zip(words, words, words, words):
+                reg[c] = handlers[op](reg, a, b)
+            self.pc = len(self.program)
+
+    def run_jumps(self):
+        """Interpret a program with the instruction pointer bound to a register."""
+        code = self.program.code
+        size = len(self.program)
+        reg = self.reg
+        handlers = HANDLERS
+        ip = self.ip
+        pc = self.pc
+        while 0 <= pc < size:
+            i = 4 * pc
+            reg[ip] = pc
+            reg[code[i + 3]] = handlers[code[i]](reg, code[i + 1], code[i + 2])
+            pc = reg[ip] + 1
+        self.pc = pc
+
+    def run_traced(self, trace: "Trace"):
+        """Interpret the program, recording each instruction in the trace.
+        This is a separate loop, so that the other engines pay nothing for
+        tracing.
+        """
+        code = self.program.code
+        size = len(self.program)
+        reg = self.reg
+        handlers = HANDLERS
+        ip = self.ip
+        pc = self.pc
+        counts, changes, jumps = trace.start(self.program, len(reg))
+        while 0 <= pc < size:
+            i = 4 * pc
+            if ip is not None:
+                reg[ip] = pc
+            c = code[i + 3]
+            old = reg[c]
+            new = reg[c] = handlers[code[i]](reg, code[i + 1], code[i + 2])
+            counts[pc] += 1
+            if new != old:
+                changes[c][new - old] += 1
+            next_pc = (reg[ip] if ip is not None else pc) + 1
+            if next_pc <= pc:
+                jumps[pc, next_pc] += 1
+            pc = next_pc
+        self.pc = pc
+
+    def run_shortcuts(self, verify: bool = False, verify_steps: int = 10000):
+        """Interpret a program with the instruction pointer bound to a
+        register, replacing each loop that matches one of IDIOMS with its
+        closed-form shortcut.  The shortcut leaves every register as the
+        loop would have, and execution continues at the loop's exit.
+
+        If verify is True, each shortcut taken is checked against the plain
+        interpreter, run from the same registers, and ValueError is raised
+        if they differ.  Loops that take more than verify_steps
+        instructions are not checked.
+        """
+        if self.ip is None:
+            self.run()
+            return
+        if self._idioms is None:
+            self._idioms = find_idioms(self.program, self.ip)
+        idioms = self._idioms
+        code = self.program.code
+        size = len(self.program)
+        reg = self.reg
+        handlers = HANDLERS
+        ip = self.ip
+        pc = self.pc
+        while 0 <= pc < size:
+            found = idioms.get(pc)
+            if found is not None:
+                idiom, env = found
+                before = list(reg)
+                if idiom.shortcut(reg, env):
+                    reg[ip] = pc + idiom.exit - 1
+                    if verify:
+                        self.check_shortcut(idiom, pc, before, verify_steps)
+                    pc += idiom.exit
+                    continue
+            i = 4 * pc
+            reg[ip] = pc
+            reg[code[i + 3]] = handlers[code[i]](reg, code[i + 1], code[i + 2])
+            pc = reg[ip] + 1
+        self.pc = pc
+
+    def check_shortcut(self, idiom: "Idiom", start: int, before: List[int], limit: int):
+        """Interpret the loop at start from the given registers, and compare
+        the result with the registers left by its shortcut.
+        """
+        dev = Device(self.program, before, self.ip)
+        dev.pc = start
+        end = start + len(idiom.pattern)
+        exit_pc = start + idiom.exit
+        for _ in range(limit):
+            dev.step()
+            if dev.pc == exit_pc or not start <= dev.pc < end:
+                break
+        else:
+            return
+        if dev.pc != exit_pc or dev.reg != self.reg:
+            raise ValueError(
+                f"Shortcut '{idiom.name}' at pc {start} from {before} gave "
+                f"{self.reg}, pc {exit_pc}; expected {dev.reg}, pc {dev.pc}"
+            )
+
+    def run_compiled(self):
+        blocks = self._blocks
+        reg = self.reg
+        size = len(self.program)
+        pc = self.pc
+        while 0 <= pc < size:
+            block = blocks.get(pc)
+            if block is None:
+                block = blocks[pc] = compile_block(self.program, pc, self.ip, len(reg))
+            pc = block(reg)
+        self.pc = pc
 
     def step(self):
         """Excute a single instruction."""
-        ins = self.prog[self.pc]
-        if ins.op == "addr":
-            self.reg[ins.C] = self.reg[ins.A] + self.reg[ins.B]
-        elif ins.op == "addi":
-            self.reg[ins.C] = self.reg[ins.A] + ins.B
-        elif ins.op == "mulr":
-            self.reg[ins.C] = self.reg[ins.A] * self.reg[ins.B]
-        elif ins.op == "muli":
-            self.reg[ins.C] = self.reg[ins.A] * ins.B
-        elif ins.op == "banr":
-            self.reg[ins.C] = self.reg[ins.A] & self.reg[ins.B]
-        elif ins.op == "bani":
-            self.reg[ins.C] = self.reg[ins.A] & ins.B
-        elif ins.op == "borr":
-            self.reg[ins.C] = self.reg[ins.A] | self.reg[ins.B]
-        elif ins.op == "bori":
-            self.reg[ins.C] = self.reg[ins.A] | ins.B
-        elif ins.op == "setr":
-            self.reg[ins.C] = self.reg[ins.A]
-        elif ins.op == "seti":
-            self.reg[ins.C] = ins.A
-        elif ins.op == "gtir":
-            self.reg[ins.C] = int(ins.A > self.reg[ins.B])
-        elif ins.op == "gtri":
-            self.reg[ins.C] = int(self.reg[ins.A] > ins.B)
-        elif ins.op == "gtrr":
-            self.reg[ins.C] = int(self.reg[ins.A] > self.reg[ins.B])
-        elif ins.op == "eqir":
-            self.reg[ins.C] = int(ins.A == self.reg[ins.B])
-        elif ins.op == "eqri":
-            self.reg[ins.C] = int(self.reg[ins.A] == ins.B)
-        elif ins.op == "eqrr":
-            self.reg[ins.C] = int(self.reg[ins.A] == self.reg[ins.B])
-        else:
-            raise ValueError(f"Unrecognized opcode '{ins.op}'")
+        if self.ip is not None:
+            self.reg[self.ip] = self.pc
+        op, a, b, c = self.program[self.pc]
+        self.reg[c] = HANDLERS[op](self.reg, a, b)
+        if self.ip is not None:
+            self.pc = self.reg[self.ip]
         self.pc += 1
 
 
+class BatchDevice():
+    """Many devices running the same program in lockstep, each from its own
+    registers.  Requires NumPy.
+
+    reg is an N x nreg array with one row, or lane, per device, and pc holds
+    the pc of each lane.  Each step applies the instruction at each distinct
+    pc to all the lanes at that pc at once.  Lanes whose pc has left the
+    program have halted, and are left alone.  Register values are 64-bit
+    integers, rather than Python ints.
+    """
+    def __init__(
+        self,
+        prog: Union[Program, Sequence[Instruction]],
+        reg: Sequence[Sequence[int]],
+        ip: Optional[int] = None
+    ):
+        if np is None:
+            raise ImportError("BatchDevice requires NumPy")
+        if isinstance(prog, Program):
+            self.program = prog
+        else:
+            self.program = Program.from_instructions(prog)
+        self.ip = ip if ip is not None else self.program.ip
+        self.reg = np.array(reg, dtype=np.int64)
+        if self.reg.ndim != 2:
+            raise ValueError("Registers must be given as one row per lane")
+        self.pc = np.zeros(len(self.reg), dtype=np.int64)
+        self._decoded = [self.decode(pc) for pc in range(len(self.program))]
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str], reg: Sequence[Sequence[int]]) -> "BatchDevice":
+        return cls(Program.from_lines(lines), reg)
+
+    def decode(self, pc: int) -> tuple:
+        """Return the batch operation for the instruction at pc, with its
+        inputs as register numbers or 64-bit values, and its output register.
+        """
+        op, a, b, c = self.program[pc]
+        name = OPCODES[op]
+        _, a_reg, b_reg = SOURCE[name]
+        nreg = self.reg.shape[1]
+        for val, is_reg in ((a, a_reg), (b, b_reg), (c, True)):
+            if is_reg and not 0 <= val < nreg:
+                raise ValueError(f"Invalid register {val} at pc {pc}")
+        operation = BATCH_OPERATIONS[name[:2] if name[:2] in ("gt", "eq") else name[:3]]
+        return (
+            operation,
+            a if a_reg else None, np.int64(a),
+            b if b_reg else None, np.int64(b),
+            c
+        )
+
+    def running(self):
+        """Return a boolean array, True for each lane that hasn't halted."""
+        return (self.pc >= 0) & (self.pc < len(self.program))
+
+    def step(self) -> int:
+        """Execute one instruction in every running lane, and return the
+        number of lanes that ran.
+        """
+        lanes = np.flatnonzero(self.running())
+        if not lanes.size:
+            return 0
+        reg, pc, ip = self.reg, self.pc, self.ip
+        pcs = pc[lanes]
+        first = pcs[0]
+        if (pcs == first).all():
+            groups = [(first, lanes if lanes.size < len(reg) else slice(None))]
+        else:
+            groups = [(p, lanes[pcs == p]) for p in np.unique(pcs)]
+        for p, sel in groups:
+            operation, a_reg, a, b_reg, b, c = self._decoded[p]
+            if ip is not None:
+                reg[sel, ip] = p
+            x = reg[sel, a_reg] if a_reg is not None else a
+            y = reg[sel, b_reg] if b_reg is not None else b
+            reg[sel, c] = operation(x, y)
+            pc[sel] = reg[sel, ip] + 1 if ip is not None else p + 1
+        return lanes.size
+
+    def run(self, max_steps: Optional[int] = None):
+        """Run until every lane has halted, or for at most max_steps steps,
+        and return the register matrix.
+        """
+        steps = 0
+        while (max_steps is None or steps < max_steps) and self.step():
+            steps += 1
+        return self.reg
+
+
+class Trace():
+    """Execution statistics for a traced run of a Device.
+
+    counts holds the number of times each pc was executed.  changes holds,
+    for each register, a Counter of the amounts by which writes changed it.
+    jumps counts the backward jumps, keyed by (from pc, to pc); each one
+    that repeats closes a loop over the pcs between them.
+    """
+    def __init__(self):
+        self.program = Program()
+        self.counts: List[int] = []
+        self.changes: List[Counter] = []
+        self.jumps: Counter = Counter()
+
+    def start(self, program: Program, nreg: int) -> tuple:
+        if len(self.counts) < len(program):
+            self.counts.extend([0] * (len(program) - len(self.counts)))
+        if len(self.changes) < nreg:
+            self.changes.extend(Counter() for _ in range(nreg - len(self.changes)))
+        self.program = program
+        return self.counts, self.changes, self.jumps
+
+    @property
+    def steps(self) -> int:
+        return sum(self.counts)
+
+    def hot_loops(self, min_repeat: int = 2) -> List[Tuple[int, int, int, int]]:
+        """Return (steps, start, end, repeats) for each backward jump taken
+        at least min_repeat times, busiest first.  The loop body runs from
+        pc start to pc end, and steps counts the instructions executed in it.
+        """
+        loops = []
+        for (end, start), repeats in self.jumps.items():
+            if repeats >= min_repeat:
+                loops.append((sum(self.counts[start:end + 1]), start, end, repeats))
+        return sorted(loops, reverse=True)
+
+    def report(self, top: int = 5) -> str:
+        """Return a compact text summary of the hottest loops, pcs and
+        register changes.
+        """
+        steps = self.steps or 1
+        lines = [f"{self.steps} instructions executed, {len(self.program)} in program"]
+        lines.append("hot loops:")
+        for loop_steps, start, end, repeats in self.hot_loops()[:top]:
+            lines.append(f"  pc {start:>3d}-{end:<3d} {repeats:>10d} repeats "
+                         f"{loop_steps:>12d} steps {100 * loop_steps / steps:6.1f}%")
+        lines.append("hot pcs:")
+        hot = sorted(range(len(self.counts)), key=lambda pc: -self.counts[pc])
+        for pc in hot[:top]:
+            if self.counts[pc]:
+                op, a, b, c = self.program[pc]
+                text = f"{OPCODES[op]} {a} {b} {c}"
+                lines.append(f"  pc {pc:>3d}  {text:<16s} {self.counts[pc]:>12d} "
+                             f"{100 * self.counts[pc] / steps:6.1f}%")
+        lines.append("register changes:")
+        for n, changes in enumerate(self.changes):
+            if changes:
+                common = ", ".join(f"{delta:+d} x{count}" for delta, count in changes.most_common(3))
+                lines.append(f"  r{n} {sum(changes.values()):>12d}  {common}")
+        return "\n".join(lines)
+
+
+def run_stepped(dev: Device) -> None:
+    while 0 <= dev.pc < len(dev.program):
+        dev.step()
+
+
+# Each way of running a Device to completion.  They must all leave the
+# same registers and pc.
+ENGINES: Dict[str, Callable[[Device], None]] = {
+    "stepped": run_stepped,
+    "interpreted": lambda dev: dev.run(),
+    "compiled": lambda dev: dev.run(compiled=True),
+    "traced": lambda dev: dev.run(trace=Trace()),
+    "shortcuts": lambda dev: dev.run(shortcuts=True),
+}
+
+
+def random_program(
+    rng: random.Random,
+    length: int,
+    nreg: int = 4,
+    ip: Optional[int] = None,
+    max_value: int = 16
+) -> Program:
+    """Return a random program of the given length, that always halts.
+
+    If ip is given, the instruction pointer is bound to that register, and
+    instructions that write it only ever jump forwards: they add a small
+    value to it, set it past their own pc, or add the result of the
+    comparison just before them.  No jump lands on one of those, so the
+    comparison always runs first.
+    """
+    code = array("i")
+    targets = set()
+    for pc in range(length):
+        name = rng.choice(OPCODES)
+        _, a_reg, b_reg = SOURCE[name]
+        a = rng.randrange(nreg) if a_reg else rng.randrange(max_value)
+        b = rng.randrange(nreg) if b_reg else rng.randrange(max_value)
+        c = rng.randrange(nreg)
+        if c == ip:
+            prev = code[-4:]
+            conditional = (
+                prev and OPCODES[prev[0]][:2] in ("gt", "eq")
+                and prev[3] != ip and pc not in targets
+            )
+            if conditional:
+                name, a, b = "addr", prev[3], ip
+                targets.add(pc + 2)
+            elif rng.random() < 0.5:
+                name, a, b = "addi", ip, rng.randrange(4)
+                targets.add(pc + b + 1)
+            else:
+                name, a, b = "seti", pc + rng.randrange(4), 0
+                targets.add(a + 1)
+        code.extend((OPCODE_INDEX[name], a, b, c))
+    return Program(code, ip)
+
+
+@dataclass
+class Idiom():
+    """A loop that can be replaced by a closed-form computation.
+
+    The pattern holds one line per instruction of the loop, starting at its
+    first instruction, in the same form as a program.  Operands in the
+    pattern are matched as follows:
+
+      P       the instruction pointer register
+      @loop   the pc before the first instruction, the target of the jump back
+      _       any value
+      #name   any value, bound to name
+      name    any register, bound to name; different names are different
+              registers, and none of them is P
+      N       exactly N
+
+    A pattern line "*" matches any instruction.  Inputs of addr, mulr, banr,
+    borr and eqrr may match in either order.
+
+    shortcut(reg, env) updates the registers as the loop would, given the
+    bindings, and returns True, or returns False to leave the loop to the
+    interpreter.  The loop then continues at pc start + exit, with P holding
+    the pc before it.
+    """
+    name: str
+    pattern: List[str]
+    exit: int
+    shortcut: Callable[[List[int], Dict[str, int]], bool]
+
+    def __post_init__(self):
+        self.tokens = [line.split() for line in self.pattern]
+
+
+COMMUTATIVE = {"addr", "mulr", "banr", "borr", "eqrr"}
+
+
+def sum_shortcut(reg: List[int], env: Dict[str, int]) -> bool:
+    """do { i += 1; acc += i } while n > i"""
+    i, n = reg[env["i"]], reg[env["n"]]
+    k = max(1, n - i)
+    reg[env["acc"]] += k * i + k * (k + 1) // 2
+    reg[env["i"]] = i + k
+    reg[env["t"]] = 0
+    return True
+
+
+def divisor_shortcut(reg: List[int], env: Dict[str, int]) -> bool:
+    """do { if i * j == n: acc += i; j += 1 } while not j > n"""
+    i, j, n = reg[env["i"]], reg[env["j"]], reg[env["n"]]
+    last = max(j, n)
+    if i != 0 and n % i == 0 and j <= n // i <= last:
+        reg[env["acc"]] += i
+    reg[env["j"]] = last + 1
+    reg[env["t"]] = 1
+    return True
+
+
+def quotient_shortcut(reg: List[int], env: Dict[str, int]) -> bool:
+    """while not (j + 1) * k > n: j += 1"""
+    k = env["#k"]
+    if k <= 0:
+        return False
+    reg[env["j"]] = max(reg[env["j"]], reg[env["n"]] // k)
+    reg[env["t"]] = 1
+    return True
+
+
+IDIOMS: List[Idiom] = [
+    Idiom("sum", [
+        "addi i 1 i",
+        "addr acc i acc",
+        "gtrr n i t",
+        "addr P t P",
+        "*",
+        "seti @loop _ P",
+    ], 4, sum_shortcut),
+    Idiom("divisor", [
+        "mulr i j t",
+        "eqrr t n t",
+        "addr t P P",
+        "addi P 1 P",
+        "addr i acc acc",
+        "addi j 1 j",
+        "gtrr j n t",
+        "addr P t P",
+        "seti @loop _ P",
+    ], 9, divisor_shortcut),
+    Idiom("quotient", [
+        "addi j 1 t",
+        "muli t #k t",
+        "gtrr t n t",
+        "addr t P P",
+        "addi P 1 P",
+        "*",
+        "addi j 1 j",
+        "seti @loop _ P",
+    ], 5, quotient_shortcut),
+]
+
+
+def match_idiom(
+    idiom: Idiom,
+    program: Program,
+    start: int,
+    ip: int
+) -> Optional[Dict[str, int]]:
+    """Return the bindings if the program matches the idiom's pattern at
+    the given pc, or None if it doesn't.
+    """
+    pattern = idiom.tokens
+    if start + len(pattern) > len(program):
+        return None
+
+    def bind(token, value, env):
+        if token == "_":
+            return env
+        if token == "P":
+            return env if value == ip else None
+        if token == "@loop":
+            return env if value == start - 1 else None
+        if token.lstrip("-").isdigit():
+            return env if value == int(token) else None
+        if token in env:
+            return env if env[token] == value else None
+        if not token.startswith("#"):
+            if value == ip or any(v == value for k, v in env.items() if k[0] != "#"):
+                return None
+        return {**env, token: value}
+
+    def match(n, env):
+        if n == len(pattern):
+            return env
+        if pattern[n] == ["*"]:
+            return match(n + 1, env)
+        name, ta, tb, tc = pattern[n]
+        op, a, b, c = program[start + n]
+        if OPCODES[op] != name:
+            return None
+        for x, y in ((a, b), (b, a)) if name in COMMUTATIVE else ((a, b),):
+            bound = env
+            for token, value in ((ta, x), (tb, y), (tc, c)):
+                bound = bind(token, value, bound)
+                if bound is None:
+                    break
+            else:
+                result = match(n + 1, bound)
+                if result is not None:
+                    return result
+        return None
+
+    return match(0, {})
+
+
+def find_idioms(program: Program, ip: int) -> Dict[int, Tuple[Idiom, Dict[str, int]]]:
+    """Return the idiom and bindings for each pc where a loop in the program
+    matches one of IDIOMS.
+    """
+    found = {}
+    code = program.code
+    for start in range(len(program)):
+        for idiom in IDIOMS:
+            if OPCODES[code[4 * start]] != idiom.tokens[0][0]:
+                continue
+            env = match_idiom(idiom, program, start, ip)
+            if env is not None:
+                found[start] = (idiom, env)
+                break
+    return found
+
+
+def compile_block(
+    program: Program,
+    start: int,
+    ip: Optional[int] = None,
+    nreg: int = 4
+) -> Callable[[list[int]], int]:
+    """Compile the basic block of a program that starts at the given pc
+    into a Python function.  The function takes the list of
+    registers, updates it in place, and returns the pc of the next
+    instruction.
+
+    A block runs to the first instruction that writes the instruction
+    pointer register, or to the end of the program.  Within the block,
+    registers are held in local variables, and reads of the instruction
+    pointer register are replaced by the pc of the instruction.
+    """
+    names = [f"r{n}" for n in range(nreg)]
+
+    def operand(val, is_reg, pc):
+        if not is_reg:
+            return repr(val)
+        if val == ip:
+            return str(pc)
+        if not 0 <= val < nreg:
+            raise ValueError(f"Invalid register {val} at pc {pc}")
+        return names[val]
+
+    body = []
+    pc = start
+    while pc < len(program):
+        op, a, b, c = program[pc]
+        template, a_reg, b_reg = SOURCE[OPCODES[op]]
+        expr = template.format(a=operand(a, a_reg, pc), b=operand(b, b_reg, pc))
+        if not 0 <= c < nreg:
+            raise ValueError(f"Invalid register {c} at pc {pc}")
+        body.append(f"    {names[c]} = {expr}")
+        if c == ip:
+            body.append(f"    next_pc = {names[c]} + 1")
+            break
+        pc += 1
+    else:
+        if ip is not None:
+            body.append(f"    {names[ip]} = {pc - 1}")
+        body.append(f"    next_pc = {pc}")
+
+    regs = ", ".join(names)
+    source = "\n".join(
+        [f"def block(reg):", f"    {regs}, = reg"] +
+        body +
+        [f"    reg[:] = {regs},", "    return next_pc"]
+    )
+    namespace = {}
+    exec(source, namespace)
+    return namespace["block"]
+
+
 def solve2(lines: Lines) -> int:
     """Solve the problem."""
     return 0
@@ -190,48 +898,196 @@ def matching_opcodes(sample) -> List[str]:
     return numcode, matches
 
 
+# A parsed sample: the registers before, the instruction as four numbers,
+# and the registers after.
+Sample = Tuple[List[int], List[int], List[int]]
+
+ALL_OPCODES = (1 << len(OPCODES)) - 1
+
+# Operations on whole arrays of inputs, by opcode name without its final
+# 'r'/'i' (or 'ir'/'ri'/'rr') suffix.
+BATCH_OPERATIONS = {
+    "add": lambda x, y: x + y,
+    "mul": lambda x, y: x * y,
+    "ban": lambda x, y: x & y,
+    "bor": lambda x, y: x | y,
+    "set": lambda x, y: x,
+    "gt": lambda x, y: (x > y).astype(x.dtype),
+    "eq": lambda x, y: (x == y).astype(x.dtype),
+}
+
+
+def sample_values(lines) -> Sample:
+    reg, ins, expected = parse_sample(lines)
+    return reg, [int(ins.op), ins.A, ins.B, ins.C], expected
+
+
+def candidate_masks(samples: Sequence[Sample]) -> List[int]:
+    """Return a bitmask for each sample, with bit i set if opcode OPCODES[i]
+    turns the registers before into the registers after.  If NumPy is
+    available, each opcode is evaluated over all the samples at once.
+    """
+    if np is None or not samples:
+        return [candidate_mask(sample) for sample in samples]
+    return candidate_masks_numpy(samples).tolist()
+
+
+def candidate_mask(sample: Sample) -> int:
+    """Return the bitmask of opcodes that match a single sample.  An opcode
+    whose register operands are not all valid registers never matches.
+    """
+    before, (_, a, b, c), after = sample
+    nreg = len(before)
+    if not 0 <= c < nreg:
+        return 0
+    a_ok = 0 <= a < nreg
+    b_ok = 0 <= b < nreg
+    mask = 0
+    for idx, (op, handler) in enumerate(zip(OPCODES, HANDLERS)):
+        _, a_reg, b_reg = SOURCE[op]
+        if (a_reg and not a_ok) or (b_reg and not b_ok):
+            continue
+        reg = list(before)
+        reg[c] = handler(reg, a, b)
+        if reg == after:
+            mask |= 1 << idx
+    return mask
+
+
+def candidate_masks_numpy(samples: Sequence[Sample]):
+    """Return the candidate bitmasks for all samples, as a NumPy array."""
+    data = np.array([before + ins + after for before, ins, after in samples], dtype=np.int64)
+    before, ins, after = data[:, 0:4], data[:, 4:8], data[:, 8:12]
+    nreg = before.shape[1]
+    rows = np.arange(len(data))
+    a, b, c = ins[:, 1], ins[:, 2], ins[:, 3]
+    a_ok = (a >= 0) & (a < nreg)
+    b_ok = (b >= 0) & (b < nreg)
+    c_ok = (c >= 0) & (c < nreg)
+    reg_a = before[rows, np.where(a_ok, a, 0)]
+    reg_b = before[rows, np.where(b_ok, b, 0)]
+    c = np.where(c_ok, c, 0)
+
+    # Every register except C must be unchanged.
+    same = (before == after) | (np.arange(nreg) == c[:, None])
+    valid = c_ok & same.all(axis=1)
+    result = after[rows, c]
+
+    masks = np.zeros(len(data), dtype=np.int64)
+    for idx, op in enumerate(OPCODES):
+        _, a_reg, b_reg = SOURCE[op]
+        name = op[:2] if op[:2] in ("gt", "eq") else op[:3]
+        x = reg_a if a_reg else a
+        y = reg_b if b_reg else b
+        ok = valid & (a_ok if a_reg else True) & (b_ok if b_reg else True)
+        match = ok & (BATCH_OPERATIONS[name](x, y) == result)
+        masks |= match.astype(np.int64) << idx
+    return masks
+
+
+def mask_opcodes(mask: int) -> List[Opcode]:
+    return [op for idx, op in enumerate(OPCODES) if mask & (1 << idx)]
+
+
+def propagate_masks(masks: Dict[int, int]) -> Optional[Dict[int, int]]:
+    """Narrow down the candidate opcode masks for each instruction number.
+
+    An opcode that is the only candidate for one number is removed from
+    all the others.  When every opcode has a number, an opcode that is a
+    candidate for only one number is assigned to it.  This is repeated
+    until nothing changes.  Return the narrowed masks, or None if some
+    number is left with no candidates.
+    """
+    masks = dict(masks)
+    complete = len(masks) == len(OPCODES)
+    changed = True
+    while changed:
+        changed = False
+        for numcode, mask in masks.items():
+            if not mask:
+                return None
+            if mask.bit_count() == 1:
+                for other, other_mask in masks.items():
+                    if other != numcode and other_mask & mask:
+                        masks[other] = other_mask & ~mask
+                        changed = True
+        if complete:
+            for idx in range(len(OPCODES)):
+                bit = 1 << idx
+                holders = [numcode for numcode, mask in masks.items() if mask & bit]
+                if not holders:
+                    return None
+                if len(holders) == 1 and masks[holders[0]] != bit:
+                    masks[holders[0]] = bit
+                    changed = True
+    return masks
+
+
+def search_masks(masks: Dict[int, int], solutions: list, limit: int = 2) -> None:
+    """Find assignments consistent with the candidate masks, by propagation
+    and then backtracking on the number with the fewest candidates.  Stop
+    once 'limit' solutions have been added to the solutions list.
+    """
+    masks = propagate_masks(masks)
+    if masks is None:
+        return
+    open_codes = [numcode for numcode, mask in masks.items() if mask.bit_count() > 1]
+    if not open_codes:
+        solutions.append(masks)
+        return
+    numcode = min(open_codes, key=lambda numcode: masks[numcode].bit_count())
+    mask = masks[numcode]
+    while mask and len(solutions) < limit:
+        bit = mask & -mask
+        mask &= ~bit
+        search_masks({**masks, numcode: bit}, solutions, limit)
+
+
+def assign_opcodes(masks: Dict[int, int]) -> Dict[int, Opcode]:
+    """Return the one assignment of opcodes to instruction numbers that is
+    consistent with the candidate masks for each number.  Raise ValueError
+    if the samples contradict each other, or allow more than one answer.
+    """
+    solutions = []
+    search_masks(masks, solutions)
+    if not solutions:
+        raise ValueError("Samples are contradictory: no assignment of opcodes fits them")
+    if len(solutions) > 1:
+        first, second = solutions
+        ambiguous = {
+            numcode: mask_opcodes(masks[numcode])
+            for numcode in sorted(first) if first[numcode] != second[numcode]
+        }
+        raise ValueError(f"Samples are ambiguous: {ambiguous}")
+    return {
+        numcode: OPCODES[mask.bit_length() - 1]
+        for numcode, mask in solutions[0].items()
+    }
+
+
+def resolve_opcodes(samples) -> Dict[int, Opcode]:
+    """Work out which opcode each instruction number stands for."""
+    values = [sample_values(sample) for sample in samples]
+    masks = {}
+    for (_, ins, _), mask in zip(values, candidate_masks(values)):
+        masks[ins[0]] = masks.get(ins[0], ALL_OPCODES) & mask
+    return assign_opcodes(masks)
+
+
+def translate_program(lines, strcode: Dict[int, Opcode]) -> Program:
+    """Parse program lines that use instruction numbers, using the given
+    map from number to opcode.
+    """
+    return Program.from_lines(lines, strcode)
+
+
 def solve2(parts) -> int:
     """Solve the problem."""
     samples = parts[:-1]
     lines = parts[-1]
 
-    opcode = {}
-    for sample in samples:
-        numcode, matches = matching_opcodes(sample)
-        assert len(matches) > 0
-        if numcode not in opcode:
-            opcode[numcode] = set(matches)
-        else:
-            opcode[numcode] &= set(matches)
-
-    # for numcode, matches in opcode.items():
-    #     if matches:
-    #         print(f"{numcode} -> {list(matches)}")
-
-    strcode = {}
-    assignments = True
-    while assignments:
-        op = None
-        assignments = False
-        for numcode, matches in opcode.items():
-            if len(matches) == 1:
-                op = matches.pop()
-                strcode[numcode] = op
-                # print(f"ASSIGN {numcode} -> {op}")
-                assignments = True
-                break
-        for matches in opcode.values():
-            if matches and op in matches:
-                matches.remove(op)
-
-    # for numcode, op in sorted(strcode.items()):
-    #     print(f"{numcode} -> {op}")
-
-    prog = []
-    for line in lines:
-        vals = list(map(int, line.replace(",", " ").split()))
-        vals[0] = strcode[vals[0]]
-        prog.append(Instruction(*vals))
+    strcode = resolve_opcodes(samples)
+    prog = translate_program(lines, strcode)
 
     dev = Device(prog=prog)
     dev.run()
@@ -239,14 +1095,76 @@ def solve2(parts) -> int:
     return dev.reg[0]
 
 
+SAMPLE, INSTRUCTION = "sample", "instruction"
+
+
+def registers(line: str) -> List[int]:
+    """Parse the registers from a "Before:" or "After:" line."""
+    return [int(val) for val in line[line.index("[") + 1:line.rindex("]")].split(",")]
+
+
+def stream_input(lines: Iterable[str]) -> Iterator[Tuple[str, Any]]:
+    """Parse puzzle input one line at a time, from any iterable of lines,
+    such as an open file.  Yield (SAMPLE, sample) for each sample, and
+    (INSTRUCTION, [number, A, B, C]) for each line of the program.
+    """
+    before = ins = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("Before:"):
+            before = registers(line)
+        elif line.startswith("After:"):
+            yield SAMPLE, (before, ins, registers(line))
+            before = ins = None
+        elif before is not None:
+            ins = [int(val) for val in line.split()]
+        else:
+            yield INSTRUCTION, [int(val) for val in line.replace(",", " ").split()]
+
+
+def solve_stream(lines: Iterable[str], batch_size: int = 10000) -> Tuple[int, int]:
+    """Solve both parts in a single pass over the input lines.  Samples are
+    matched in batches of batch_size, and only the candidate masks for each
+    instruction number and the packed program are kept.
+    """
+    count = 0
+    masks = {}
+    batch = []
+    program = None
+
+    def flush():
+        nonlocal count
+        for (_, ins, _), mask in zip(batch, candidate_masks(batch)):
+            if mask.bit_count() >= 3:
+                count += 1
+            masks[ins[0]] = masks.get(ins[0], ALL_OPCODES) & mask
+        batch.clear()
+
+    for kind, item in stream_input(lines):
+        if kind == SAMPLE:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+        else:
+            if program is None:
+                flush()
+                strcode = assign_opcodes(masks)
+                program = Program()
+            numcode, a, b, c = item
+            program.code.extend((OPCODE_INDEX[strcode[numcode]], a, b, c))
+    flush()
+
+    dev = Device(prog=program or Program())
+    dev.run()
+    return count, dev.reg[0]
+
+
 def solve(samples) -> int:
     """Solve the problem."""
-    result = 0
-    for sample in samples:
-        _, matches = matching_opcodes(sample)
-        if len(matches) >= 3:
-          result += 1
-    return result
+    masks = candidate_masks([sample_values(sample) for sample in samples])
+    return sum(1 for mask in masks if mask.bit_count() >= 3)
 
 
 # PART 1
@@ -282,8 +1200,18 @@ def part2(lines: Lines) -> None:
     print("= " * 32)
 
 
+def part_stream(infile: str) -> None:
+    print("STREAMED:")
+    with open(infile) as handle:
+        result = solve_stream(handle)
+    print(f"result is {result}")
+    assert result == (651, 706)
+    print("= " * 32)
+
+
 if __name__ == "__main__":
     example1()
     input_lines = load_input(INPUTFILE)
     part1(input_lines)
     part2(input_lines)
+    part_stream(INPUTFILE)
@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
+from pathlib import Path
+import random
+
 import pytest
 
-from day16 import Device
+from day16 import (
+    Device, Program, OPCODES, INPUTFILE, load_input, parse_sections,
+    matching_opcodes, sample_values, candidate_mask, candidate_masks_numpy,
+    mask_opcodes, assign_opcodes, OPCODE_INDEX, solve_stream, Trace, IDIOMS, find_idioms,
+    BatchDevice, OPERATIONS, ENGINES, random_program,
+)
+
+INPUT_PATH = Path(__file__).with_name(INPUTFILE)
 
 
 OPCODE_CASES = [
@@ -120,3 +130,311 @@ def test_opcode(prog, reg, expected):
     dev.load_prog(prog)
     dev.step()
     assert dev.reg == expected
+
+def test_unknown_opcode():
+    with pytest.raises(ValueError):
+        Device().load_prog(["nope, 0, 1, 2"])
+
+
+# Sum 1..N, with N in register 2, jumping through the instruction pointer.
+LOOP_PROG = [
+    "#ip 4",
+    "addi 1 1 1",
+    "addr 0 1 0",
+    "gtrr 2 1 3",
+    "addr 4 3 4",
+    "seti 99 0 4",
+    "seti -1 0 4",
+]
+
+@pytest.mark.parametrize("prog,reg,expected", OPCODE_CASES)
+def test_compiled(prog, reg, expected):
+    dev = Device(reg=reg)
+    dev.load_prog(prog)
+    dev.run(compiled=True)
+    assert dev.reg == expected
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_jumps(compiled):
+    dev = Device(reg=[0, 0, 10, 0, 0])
+    dev.load_prog(LOOP_PROG)
+    dev.run(compiled=compiled)
+    assert dev.reg[:3] == [55, 10, 10]
+    assert dev.pc == 100
+
+def test_trace():
+    dev = Device(reg=[0, 0, 10, 0, 0])
+    dev.load_prog(LOOP_PROG)
+    trace = Trace()
+    dev.run(trace=trace)
+    assert dev.reg[:3] == [55, 10, 10]
+    assert dev.pc == 100
+    assert trace.counts == [10, 10, 10, 10, 1, 9]
+    assert trace.jumps == {(5, 0): 9}
+    assert trace.changes[1] == {1: 10}
+    steps, start, end, repeats = trace.hot_loops()[0]
+    assert (start, end, repeats) == (0, 5, 9)
+    assert "pc   0-5" in trace.report()
+
+
+# Sum of the divisors of N, with N in register 4.
+DIVISOR_PROG = [
+    "#ip 5",
+    "seti 1 0 1",
+    "seti 1 0 2",
+    "mulr 1 2 3",
+    "eqrr 3 4 3",
+    "addr 3 5 5",
+    "addi 5 1 5",
+    "addr 1 0 0",
+    "addi 2 1 2",
+    "gtrr 2 4 3",
+    "addr 5 3 5",
+    "seti 1 0 5",
+    "addi 1 1 1",
+    "gtrr 1 4 3",
+    "addr 3 5 5",
+    "seti 0 0 5",
+    "seti 99 0 5",
+]
+
+# N // 256 in register 5, with N in register 3.
+QUOTIENT_PROG = [
+    "#ip 1",
+    "seti 0 0 5",
+    "addi 5 1 2",
+    "muli 2 256 2",
+    "gtrr 2 3 2",
+    "addr 2 1 1",
+    "addi 1 1 1",
+    "seti 8 0 1",
+    "addi 5 1 5",
+    "seti 0 0 1",
+]
+
+def test_find_idioms():
+    cases = [(LOOP_PROG, {0: "sum"}), (DIVISOR_PROG, {2: "divisor"}), (QUOTIENT_PROG, {1: "quotient"})]
+    for prog, expected in cases:
+        dev = Device().load_prog(prog)
+        found = find_idioms(dev.program, dev.ip)
+        assert {pc: idiom.name for pc, (idiom, _) in found.items()} == expected
+    assert find_idioms(Device().load_prog(["#ip 4"] + LOOP_PROG[2:]).program, 4) == {}
+
+@pytest.mark.parametrize("prog,reg", [
+    (LOOP_PROG, [0, 0, 10, 0, 0]),
+    (LOOP_PROG, [0, 7, 3, 0, 0]),
+    (DIVISOR_PROG, [0, 0, 0, 0, 10, 0]),
+    (DIVISOR_PROG, [0, 0, 0, 0, 36, 0]),
+    (DIVISOR_PROG, [0, 0, 0, 0, 1, 0]),
+    (QUOTIENT_PROG, [0, 0, 0, 1000, 0, 0]),
+    (QUOTIENT_PROG, [0, 0, 0, 255, 0, 0]),
+    (QUOTIENT_PROG, [0, 0, 0, -5, 0, 0]),
+])
+def test_shortcuts(prog, reg):
+    plain = Device(reg=reg).load_prog(prog)
+    plain.run()
+    fast = Device(reg=reg).load_prog(prog)
+    fast.run_shortcuts(verify=True)
+    assert fast.reg == plain.reg
+    assert fast.pc == plain.pc
+
+def test_shortcuts_large():
+    dev = Device(reg=[0, 0, 0, 0, 10000, 0]).load_prog(DIVISOR_PROG)
+    dev.run(shortcuts=True)
+    assert dev.reg[0] == 24211
+
+def test_shortcuts_verify(monkeypatch):
+    idiom = next(idiom for idiom in IDIOMS if idiom.name == "sum")
+
+    def wrong(reg, env):
+        reg[env["acc"]] += 1
+        return True
+
+    monkeypatch.setattr(idiom, "shortcut", wrong)
+    dev = Device(reg=[0, 0, 10, 0, 0]).load_prog(LOOP_PROG)
+    with pytest.raises(ValueError):
+        dev.run_shortcuts(verify=True)
+
+
+def test_batch_device():
+    pytest.importorskip("numpy")
+    regs = [[0, 0, 0, 0, n, 0] for n in range(1, 13)]
+    batch = BatchDevice.from_lines(DIVISOR_PROG, regs)
+    result = batch.run()
+    for reg, row in zip(regs, result.tolist()):
+        dev = Device(reg=reg).load_prog(DIVISOR_PROG)
+        dev.run()
+        assert row == dev.reg
+    assert not batch.running().any()
+
+def test_batch_device_straight():
+    pytest.importorskip("numpy")
+    regs = [reg for _, reg, _ in OPCODE_CASES]
+    prog = Program.from_lines(line for prog, _, _ in OPCODE_CASES for line in prog)
+    result = BatchDevice(prog, regs).run()
+    for reg, row in zip(regs, result.tolist()):
+        dev = Device(prog=prog, reg=reg)
+        dev.run()
+        assert row == dev.reg
+
+def test_batch_device_max_steps():
+    pytest.importorskip("numpy")
+    batch = BatchDevice.from_lines(LOOP_PROG, [[0, 0, 10, 0, 0], [0, 0, 1000, 0, 0]])
+    batch.run(max_steps=100)
+    assert batch.running().tolist() == [False, True]
+    assert batch.reg[0, 0] == 55
+
+
+def reference_run(prog, reg):
+    """Run a program with the OPERATIONS table, one instruction at a time.
+    Return the final registers and pc, and the largest value seen.
+    """
+    reg = list(reg)
+    instructions = prog.instructions()
+    ip = prog.ip
+    pc = 0
+    largest = max(map(abs, reg))
+    while 0 <= pc < len(instructions):
+        ins = instructions[pc]
+        if ip is not None:
+            reg[ip] = pc
+        reg[ins.C] = OPERATIONS[ins.op](reg, ins.A, ins.B)
+        largest = max(largest, abs(reg[ins.C]))
+        pc = (reg[ip] if ip is not None else pc) + 1
+    return reg, pc, largest
+
+@pytest.mark.parametrize("seed", range(25))
+@pytest.mark.parametrize("ip", [None, 3])
+def test_fuzz_engines(seed, ip):
+    rng = random.Random(seed)
+    # Short enough that repeated squaring can't make huge numbers.
+    prog = random_program(rng, 16, ip=ip)
+    regs = [[rng.randrange(-8, 32) for _ in range(4)] for _ in range(10)]
+    results = [reference_run(prog, reg) for reg in regs]
+    for reg, (expected, pc, _) in zip(regs, results):
+        for name, engine in ENGINES.items():
+            dev = Device(prog=prog, reg=reg)
+            engine(dev)
+            assert (dev.reg, dev.pc) == (expected, pc), name
+
+@pytest.mark.parametrize("seed", range(25))
+@pytest.mark.parametrize("ip", [None, 3])
+def test_fuzz_batch(seed, ip):
+    pytest.importorskip("numpy")
+    rng = random.Random(seed)
+    prog = random_program(rng, 16, ip=ip)
+    regs = [[rng.randrange(-8, 32) for _ in range(4)] for _ in range(10)]
+    # Lanes hold 64-bit values, so only compare those that stay in range.
+    results = [reference_run(prog, reg) for reg in regs]
+    fits = [largest < 2**63 for _, _, largest in results]
+    batch = BatchDevice(prog, [reg for reg, ok in zip(regs, fits) if ok])
+    batch.run()
+    expected = [(reg, pc) for (reg, pc, _), ok in zip(results, fits) if ok]
+    assert list(zip(batch.reg.tolist(), batch.pc.tolist())) == expected
+
+@pytest.mark.parametrize("seed", range(10))
+def test_fuzz_shortcuts(seed):
+    rng = random.Random(seed)
+    cases = [
+        (LOOP_PROG, [rng.randrange(-50, 50), rng.randrange(-20, 20), rng.randrange(-20, 40), 0, 0]),
+        (DIVISOR_PROG, [rng.randrange(-50, 50), 0, 0, 0, rng.randrange(1, 60), 0]),
+        (QUOTIENT_PROG, [0, 0, 0, rng.randrange(-3000, 3000), 0, 0]),
+    ]
+    for prog, reg in cases:
+        dev = Device(reg=reg).load_prog(prog)
+        expected, pc, _ = reference_run(dev.program, reg)
+        dev.run_shortcuts(verify=True)
+        assert (dev.reg, dev.pc) == (expected, pc)
+
+
+def test_program_roundtrip():
+    program = Program.from_lines(LOOP_PROG)
+    assert len(program) == 6
+    assert program.ip == 4
+    assert len(program.code) == 24
+    assert program.to_lines() == LOOP_PROG
+
+def test_program_numeric():
+    strcode = dict(enumerate(OPCODES))
+    numcode = {op: num for num, op in strcode.items()}
+    lines = ["9 3 0 1", "0 1 2 3"]
+    program = Program.from_lines(lines, strcode)
+    assert program.to_lines() == ["seti 3 0 1", "addr 1 2 3"]
+    assert program.to_lines(numcode) == lines
+    dev = Device(prog=program)
+    dev.run()
+    assert dev.reg == [0, 3, 0, 3]
+
+
+SAMPLE = [
+    "Before: [3, 2, 1, 1]",
+    "9 2 1 2",
+    "After:  [3, 2, 2, 1]",
+]
+
+def test_candidate_mask():
+    _, matches = matching_opcodes(SAMPLE)
+    assert mask_opcodes(candidate_mask(sample_values(SAMPLE))) == matches
+    assert sorted(matches) == ["addi", "mulr", "seti"]
+
+def test_candidate_masks_numpy():
+    pytest.importorskip("numpy")
+    lines = load_input(INPUT_PATH)
+    samples = [sample_values(sect) for sect in parse_sections(lines)[:-1]]
+    masks = candidate_masks_numpy(samples).tolist()
+    assert masks == [candidate_mask(sample) for sample in samples]
+
+def test_candidate_mask_register_bounds():
+    samples = [
+        ([1, 2, 3, 4], [0, -1, 0, 2], [1, 2, 5, 4]),
+        ([1, 2, 3, 4], [0, 0, 4, 2], [1, 2, 1, 4]),
+        ([1, 2, 3, 4], [0, 1, 1, -1], [1, 2, 3, 4]),
+    ]
+    assert candidate_mask(samples[0]) == 0
+    assert candidate_mask(samples[1]) == opcode_mask("setr")
+    assert candidate_mask(samples[2]) == 0
+    pytest.importorskip("numpy")
+    masks = candidate_masks_numpy(samples).tolist()
+    assert masks == [candidate_mask(sample) for sample in samples]
+
+
+def opcode_mask(*ops):
+    return sum(1 << OPCODE_INDEX[op] for op in ops)
+
+def test_assign_opcodes():
+    masks = {0: opcode_mask("addr", "addi"), 1: opcode_mask("addr"), 2: opcode_mask("addi", "seti")}
+    assert assign_opcodes(masks) == {0: "addi", 1: "addr", 2: "seti"}
+
+def test_assign_opcodes_chain():
+    # Each opcode is a candidate for two numbers, in a chain that is only
+    # settled by working along it from number 0.
+    masks = {
+        num: (1 << num) | (1 << (num + 1) % 16) for num in range(16)
+    }
+    masks[0] = 1 << 0
+    assert assign_opcodes(masks) == dict(enumerate(OPCODES))
+
+def test_assign_opcodes_cycle():
+    # Without number 0 fixed, the chain becomes a cycle, and propagation
+    # stalls.  The search finds both ways round.
+    masks = {
+        num: (1 << num) | (1 << (num + 1) % 16) for num in range(16)
+    }
+    with pytest.raises(ValueError, match="ambiguous"):
+        assign_opcodes(masks)
+
+def test_assign_opcodes_ambiguous():
+    masks = {0: opcode_mask("addr", "addi"), 1: opcode_mask("addr", "addi")}
+    with pytest.raises(ValueError, match="ambiguous"):
+        assign_opcodes(masks)
+
+def test_assign_opcodes_contradictory():
+    masks = {0: opcode_mask("addr"), 1: opcode_mask("addr")}
+    with pytest.raises(ValueError, match="contradictory"):
+        assign_opcodes(masks)
+
+
+@pytest.mark.parametrize("batch_size", [1, 100, 10000])
+def test_solve_stream(batch_size):
+    with open(INPUT_PATH) as handle:
+        assert solve_stream(handle, batch_size=batch_size) == (651, 706)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+#  Advent of Code 2018 - Day 17 benchmarks
+#
+import argparse
+import random
+import time
+
+from day17 import GridBoard, fill_parallel, parse_veins, split_bands
+
+SCAN_WIDTHS = [1000, 4000, 16000]
+
+
+def generate_scan(
+    width: int,
+    height: int = 1000,
+    basins: int = 1000,
+    seed: int = 0
+) -> list[str]:
+    """Return the lines of a random scan, width columns wide, holding the
+    given number of basins: open-topped clay boxes of random size, each
+    with a shorter clay bar inside or above it.  The same seed always gives
+    the same scan.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(basins):
+        w = rng.randint(3, 20)
+        h = rng.randint(2, 15)
+        x = rng.randrange(10, width - w - 10)
+        y = rng.randrange(10, height - h)
+        lines.append(f"x={x}, y={y}..{y + h}")
+        lines.append(f"x={x + w}, y={y}..{y + h}")
+        lines.append(f"y={y + h}, x={x}..{x + w}")
+        bar = rng.randint(1, max(1, w // 2))
+        bx = rng.randrange(x, x + w - bar + 1)
+        by = rng.randrange(y - 5, y + h)
+        lines.append(f"y={by}, x={bx}..{bx + bar}")
+    return lines
+
+
+def spring_columns(width: int, springs: int) -> list[int]:
+    """Return the columns of evenly spaced springs across a scan."""
+    return [(n + 1) * width // (springs + 1) for n in range(springs)]
+
+
+def bench_bands(
+    widths=SCAN_WIDTHS,
+    springs: int = 64,
+    workers: int = 4,
+    seed: int = 0
+) -> None:
+    """Fill generated scans serially and in parallel bands, and check that
+    the counts agree.
+    """
+    print(f"BANDS ({springs} springs, {workers} workers, seed={seed}):")
+    print(f"{'width':>6s} {'veins':>7s} {'bands':>6s} {'water':>8s} "
+          f"{'serial (s)':>11s} {'parallel (s)':>13s}")
+    for width in widths:
+        lines = generate_scan(width, basins=width // 4, seed=seed)
+        veins = parse_veins(lines)
+        cols = spring_columns(width, springs)
+
+        t0 = time.perf_counter()
+        board = GridBoard(veins, cols)
+        board.fill()
+        serial = time.perf_counter() - t0
+        counts = board.count_water()[0], board.count_still_water()[0]
+
+        t0 = time.perf_counter()
+        merged = fill_parallel(veins, cols, workers=workers)
+        parallel = time.perf_counter() - t0
+        if (merged.count_water()[0], merged.count_still_water()[0]) != counts:
+            raise ValueError(f"Parallel fill changed the counts for width {width}")
+
+        bands = len(split_bands(veins, cols, 4 * workers))
+        print(f"{width:>6d} {len(veins):>7d} {bands:>6d} {counts[0]:>8d} "
+              f"{serial:>11.2f} {parallel:>13.2f}")
+    print("= " * 32)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Day 17 benchmarks")
+    parser.add_argument("--widths", type=int, nargs="+", default=SCAN_WIDTHS)
+    parser.add_argument("--springs", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    bench_bands(args.widths, args.springs, args.workers, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,15 @@
 #
 #  Advent of Code 2018 - Day 17
 #
-from typing import Sequence, Union, Optional, Any, List, Dict, Tuple
+from typing import Sequence, Union, Optional, Any, List, Dict, Tuple, Iterator
 from pathlib import Path
 from collections import defaultdict
 from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
 import math
+import multiprocessing
+import os
+import random
 import re
 
 INPUTFILE = "input.txt"
@@ -109,6 +113,12 @@ def filter_blank_lines(lines: Lines) -> Lines:
 SAND, CLAY, SPRING, FLOW, STILL = ".", "#", "+", "|", "~"
 DOTDOT = ".."
 XDIM, YDIM = "x", "y"
+ORD_SAND, ORD_CLAY, ORD_SPRING, ORD_FLOW, ORD_STILL = map(ord, (SAND, CLAY, SPRING, FLOW, STILL))
+SPRING_ROW, SPRING_COL = 0, 500
+
+# How a row of water spreading sideways ends: against clay, over water
+# that flows out of the scan, or over sand that it falls into.
+WALL, DRAIN, FALL = "wall", "drain", "fall"
 
 @dataclass(order=True, frozen=True)
 class Pos():
@@ -142,19 +152,108 @@ class Pos():
 Cell = str
 
 
-def list_vals(range_text: str) -> List[int]:
+# A clay vein: (first col, last col, first row, last row)
+Vein = Tuple[int, int, int, int]
+
+
+def parse_range(range_text: str) -> Tuple[int, int]:
     if DOTDOT in range_text:
         a, b = range_text.split(DOTDOT)
         assert int(a) < int(b)
-        return list(range(int(a), int(b)+1))
-    return [int(range_text)]
+        return int(a), int(b)
+    return int(range_text), int(range_text)
+
+
+def parse_veins(lines) -> List[Vein]:
+    """Return the clay veins in a scan, one per line."""
+    veins = []
+    for line in lines:
+        m = LINE_RE.match(line)
+        if not m:
+            raise ValueError(f"unparseable line: '{line}'")
+        dim1, range1, dim2, range2 = m.groups()
+        if dim1 == XDIM:
+            veins.append(parse_range(range1) + parse_range(range2))
+        else:
+            veins.append(parse_range(range2) + parse_range(range1))
+    return veins
+
+
+class ClayIndex():
+    """The clay in each row, as sorted lists of the first and last columns
+    of its segments, and the same for the floor: the cells that hold water
+    up, which are clay to begin with, and gain still water as step() fills
+    basins.  Flowing water is never floor.
+    Segments in a row never overlap or touch, so the column nearest to
+    another can be found by bisection.
+    """
+    def __init__(self, veins: Sequence[Vein]):
+        segments = defaultdict(list)
+        for col1, col2, row1, row2 in veins:
+            for row in range(row1, row2 + 1):
+                segments[row].append((col1, col2))
+
+        self.clay: Dict[int, Tuple[List[int], List[int]]] = {}
+        self.floor: Dict[int, Tuple[List[int], List[int]]] = {}
+        for row, row_segments in segments.items():
+            starts, ends = [], []
+            for first, last in sorted(row_segments):
+                if ends and first <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], last)
+                else:
+                    starts.append(first)
+                    ends.append(last)
+            self.clay[row] = (starts, ends)
+            self.floor[row] = (list(starts), list(ends))
+
+    @staticmethod
+    def add(index, row: int, first: int, last: int) -> None:
+        """Add a segment to a row of the index, merging it with any that
+        it overlaps or touches.
+        """
+        starts, ends = index.setdefault(row, ([], []))
+        i = bisect_left(ends, first - 1)
+        j = bisect_right(starts, last + 1)
+        if i < j:
+            first = min(first, starts[i])
+            last = max(last, ends[j - 1])
+        starts[i:j] = [first]
+        ends[i:j] = [last]
+
+    def add_floor(self, row: int, first: int, last: int) -> None:
+        self.add(self.floor, row, first, last)
+
+    def wall(self, row: int, col: int, step: int) -> Optional[int]:
+        """Return the nearest clay column to col in the given row, in the
+        direction given by step, or None if there is none.
+        """
+        starts, ends = self.clay.get(row, ((), ()))
+        if step < 0:
+            i = bisect_right(starts, col - 1) - 1
+            return min(ends[i], col - 1) if i >= 0 else None
+        i = bisect_left(ends, col + 1)
+        return max(starts[i], col + 1) if i < len(starts) else None
+
+    def support(self, row: int, col: int) -> Optional[Tuple[int, int]]:
+        """Return the first and last columns of the floor segment that
+        holds up col from the given row, or None if nothing does.
+        """
+        starts, ends = self.floor.get(row, ((), ()))
+        i = bisect_right(starts, col) - 1
+        if i >= 0 and ends[i] >= col:
+            return starts[i], ends[i]
+        return None
 
 
 class Board():
     grid: dict[Pos, Cell]
 
-    def __init__(self, cells):
+    def __init__(self, cells, index: Optional[ClayIndex] = None):
         self.grid = cells
+        if index is None:
+            clay = [pos for pos, cell in cells.items() if cell == CLAY]
+            index = ClayIndex([(pos.col, pos.col, pos.row, pos.row) for pos in clay])
+        self.index = index
         self.rowmax = max([v.row for v in self.grid.keys()])
         self.rowmin = min([v.row for v in self.grid.keys()])
         self.colmax = max([v.col for v in self.grid.keys()])
@@ -168,28 +267,20 @@ class Board():
             if cell == SPRING:
                 self.fresh_flow.append(pos)
 
+        # Whether water poured in at each position flows out of the scan.
+        self.flows_out: Dict[Pos, bool] = {}
+
     @classmethod
     def from_lines(cls, lines, **kwargs) -> "Board":
         grid = defaultdict(lambda : SAND)
-        grid[Pos(0, 500)] = SPRING
-        for line in lines:
-            m = LINE_RE.match(line)
-            if not m:
-                raise ValueError("unparseable line: '{line}'")
-            dim1, range1, dim2, range2 = m.groups()
-
-            vals1 = list_vals(range1)
-            vals2 = list_vals(range2)
-            if dim1 == XDIM:
-                xvals, yvals = vals1, vals2
-            else:
-                xvals, yvals = vals2, vals1
-
-            for x in xvals:
-                for y in yvals:
+        grid[Pos(SPRING_ROW, SPRING_COL)] = SPRING
+        veins = parse_veins(lines)
+        for col1, col2, row1, row2 in veins:
+            for x in range(col1, col2 + 1):
+                for y in range(row1, row2 + 1):
                     grid[Pos(y, x)] = CLAY
 
-        return cls(grid, **kwargs)
+        return cls(grid, index=ClayIndex(veins), **kwargs)
 
     def print(self, title="", overlay=None):
         if title:
@@ -220,49 +311,69 @@ class Board():
         loc = Pos(pos.row, pos.col - 1)
         return loc, self.grid[loc]
 
-    def count_water(self) -> List[Pos]:
-        result = []
-        count = 0
-        for pos, cell in sorted(self.grid.items()):
-            if (cell in (STILL, FLOW) and
-                pos.row >= self.clay_rowmin and
-                pos.row <= self.clay_rowmax
-            ):
-                count += 1
-                # print(f"WATER:  {count:4d}:  {pos} '{cell}'")
-                result.append(pos)
-        result.sort()
-        return result
-
-    def count_still_water(self) -> List[Pos]:
-        result = []
-        count = 0
-        for pos, cell in sorted(self.grid.items()):
-            if (cell == STILL and
-                pos.row >= self.clay_rowmin and
-                pos.row <= self.clay_rowmax
-            ):
-                count += 1
-                # print(f"WATER:  {count:4d}:  {pos} '{cell}'")
-                result.append(pos)
-        result.sort()
-        return result
+    def count_water(self) -> Tuple[int, Iterator[Pos]]:
+        """Return the number of water cells within the rows of clay, and an
+        iterator over their positions, in no particular order.
+        """
+        return self.count_cells((STILL, FLOW))
+
+    def count_still_water(self) -> Tuple[int, Iterator[Pos]]:
+        """Return the number of still water cells within the rows of clay,
+        and an iterator over their positions, in no particular order.
+        """
+        return self.count_cells((STILL,))
+
+    def count_cells(self, cells) -> Tuple[int, Iterator[Pos]]:
+        rowmin, rowmax = self.clay_rowmin, self.clay_rowmax
+        count = sum(
+            1 for pos, cell in self.grid.items()
+            if cell in cells and rowmin <= pos.row <= rowmax
+        )
+        positions = (
+            pos for pos, cell in self.grid.items()
+            if cell in cells and rowmin <= pos.row <= rowmax
+        )
+        return count, positions
 
     def in_basin(self, pos) -> bool:
+        """Return whether the row at pos is walled in by clay on both sides,
+        over a floor of clay or still water, and the first and last
+        columns between the walls.  Flowing water is no floor: it runs
+        off.  The walls are found by bisecting the clay index, and every
+        cell between them must be over the floor segment under pos.
+        """
+        left, right = pos.col, pos.col
+        floor = self.index.support(pos.row + 1, pos.col)
+        if floor is not None:
+            first, last = floor
+            wall = self.index.wall(pos.row, pos.col, -1)
+            if wall is not None and wall >= first - 1:
+                left = wall
+            wall = self.index.wall(pos.row, pos.col, 1)
+            if wall is not None and wall <= last + 1:
+                right = wall
+
+        basin = (left < pos.col) and (right > pos.col)
+        return basin, left+1, right-1
+
+    def in_basin_scan(self, pos) -> bool:
+        """Return the same as in_basin(), by scanning the grid cell by cell
+        out from pos.  Slow, but kept to check the index against.
+        """
         left, right = pos.col, pos.col
         for col in range(pos.col - 1, self.colmin - 1, -1):
-            if self.grid[Pos(pos.row+1, col)] == SAND:
-                break
             if self.grid[Pos(pos.row, col)] == CLAY:
                 left = col
                 break
+            if self.grid[Pos(pos.row+1, col)] not in (CLAY, STILL):
+                break
 
         for col in range(pos.col + 1, self.colmax + 1):
-            if self.grid[Pos(pos.row+1, col)] == SAND:
-                break
             if self.grid[Pos(pos.row, col)] == CLAY:
                 right = col
                 break
+            if self.grid[Pos(pos.row+1, col)] not in (CLAY, STILL):
+                break
 
         basin = (left < pos.col) and (right > pos.col)
         return basin, left+1, right-1
@@ -291,6 +402,7 @@ class Board():
                         self.grid[Pos(pos.row, col)] = STILL
                         if self.grid[Pos(pos.row - 1, col)] == FLOW:
                             self.fresh_flow.append(Pos(pos.row - 1, col))
+                    self.index.add_floor(pos.row, left, right)
                 else:
                     pos_left, cell_left = self.left(pos)
                     if cell_left == SAND:
@@ -302,6 +414,97 @@ class Board():
                         self.fresh_flow.append(pos_right)
         return len(self.fresh_flow) == 0
 
+    def fill(self) -> None:
+        """Fill the ground with water from the spring in a single pass, by
+        dropping water down columns and spreading it across rows, rather
+        than stepping the whole system.  If there is no sand under the
+        spring, the water spreads along the spring's row instead.
+        """
+        for pos in self.fresh_flow:
+            if self.grid[pos.below()] == SAND:
+                self.pour(pos.below())
+            else:
+                cell = self.grid[pos]
+                self.pour(pos, level=pos.row)
+                self.grid[pos] = cell
+        self.fresh_flow = []
+
+    def pour(self, top: Pos, level: Optional[int] = None) -> bool:
+        """Pour water into the sand at top, and let it fall and fill the
+        ground below.  Return True if the water flows out of the scan, or
+        False if it is held, filling the ground below up to top with
+        still water.  If level is given, the water is already standing
+        on a floor at that row, and fills from there without falling.
+
+        Falls within falls are kept on a stack, rather than handled by
+        recursion, so that there is no limit to how deeply they nest.
+        Each entry holds a top and the row being filled below it.  When a
+        row spreads over an edge onto sand, the fall there is pushed, and
+        the row is spread again once it has settled: the water below is
+        then still if it was held, or flowing if it flows out.  The result
+        for each top is remembered, so that a column is only filled once.
+        """
+        grid = self.grid
+        stack = [(top, level)]
+        while stack:
+            start, row = stack.pop()
+            col = start.col
+            if row is None:
+                if start in self.flows_out:
+                    continue
+                row = start.row
+                grid[start] = FLOW
+                while row < self.rowmax and grid[Pos(row + 1, col)] == SAND:
+                    row += 1
+                    grid[Pos(row, col)] = FLOW
+                if row == self.rowmax or grid[Pos(row + 1, col)] == FLOW:
+                    self.flows_out[start] = True
+                    continue
+
+            # Standing on clay or still water: fill rows upwards until one
+            # spills over an edge.
+            fall = None
+            while row >= start.row:
+                left, left_edge = self.spread(row, col, -1)
+                if left_edge == FALL:
+                    fall = Pos(row + 1, left)
+                    break
+                right, right_edge = self.spread(row, col, 1)
+                if right_edge == FALL:
+                    fall = Pos(row + 1, right)
+                    break
+                if DRAIN in (left_edge, right_edge):
+                    for c in range(left, right + 1):
+                        grid[Pos(row, c)] = FLOW
+                    break
+                for c in range(left, right + 1):
+                    grid[Pos(row, c)] = STILL
+                row -= 1
+
+            if fall is not None:
+                stack.append((start, row))
+                stack.append((fall, None))
+            else:
+                self.flows_out[start] = row >= start.row
+        return self.flows_out.get(top, True)
+
+    def spread(self, row: int, col: int, step: int) -> Tuple[int, str]:
+        """Spread water across a row from col, in the direction given by
+        step, until it meets clay, flowing water or sand below.  Return
+        the last column reached, and how the row ends there: WALL, DRAIN
+        or FALL.
+        """
+        grid = self.grid
+        while True:
+            below = grid[Pos(row + 1, col)]
+            if below == SAND:
+                return col, FALL
+            if below == FLOW:
+                return col, DRAIN
+            if grid[Pos(row, col + step)] == CLAY:
+                return col, WALL
+            col += step
+
     def run(self, max_steps: int = 0) -> int:
         """Propagate the system until it reaches steady state, or the max_steps have
         been exceeded.  The number of steps taken is returned.
@@ -318,23 +521,410 @@ class Board():
         return steps
 
 
-def solve2(lines: Lines) -> int:
-    """Solve the problem."""
-    board = Board.from_lines(lines)
-    # board.print(title="initially")
-    board.run()
+# The columns and rows covered by a GridBoard:
+# (first col, last col, first clay row, last clay row)
+Bounds = Tuple[int, int, int, int]
+
+
+def scan_bounds(veins: Sequence[Vein], springs: Sequence[int] = (SPRING_COL,)) -> Bounds:
+    """Return the bounds of the grid for a scan: from one column left of the
+    leftmost clay or spring to one column right of the rightmost, which is
+    as far as water can spread, and the rows of clay.
+    """
+    return (
+        min(min(vein[0] for vein in veins), *springs) - 1,
+        max(max(vein[1] for vein in veins), *springs) + 1,
+        min(vein[2] for vein in veins),
+        max(vein[3] for vein in veins),
+    )
+
+
+class GridBoard():
+    """The ground as a dense grid, with one bytearray of cell symbols per
+    row.  The grid runs from the springs' row down to the lowest clay, and
+    across the columns given by scan_bounds(), unless other bounds are
+    given.  Columns are stored relative to the left edge, at offset left.
+
+    Water comes from a spring at SPRING_COL, or from one in each of the
+    given spring columns.
+    """
+    rows: List[bytearray]
+
+    def __init__(
+        self,
+        veins: Sequence[Vein],
+        springs: Sequence[int] = (SPRING_COL,),
+        bounds: Optional[Bounds] = None
+    ):
+        first, last, self.clay_rowmin, self.clay_rowmax = bounds or scan_bounds(veins, springs)
+        self.rowmin = SPRING_ROW
+        self.rowmax = self.clay_rowmax
+        self.left = first
+        self.width = last + 1 - first
+
+        self.rows = [bytearray(SAND * self.width, "ascii") for _ in range(self.rowmax + 1)]
+        for col1, col2, row1, row2 in veins:
+            clay = CLAY.encode() * (col2 - col1 + 1)
+            for row in range(row1, row2 + 1):
+                self.rows[row][col1 - self.left:col2 - self.left + 1] = clay
+        self.springs = [col - self.left for col in springs]
+        for col in self.springs:
+            self.rows[SPRING_ROW][col] = ORD_SPRING
+
+        # Whether water poured in at each (row, col) flows out of the scan.
+        self.flows_out: Dict[Tuple[int, int], bool] = {}
+
+    @classmethod
+    def from_lines(cls, lines, **kwargs) -> "GridBoard":
+        return cls(parse_veins(lines), **kwargs)
+
+    def print(self, title=""):
+        if title:
+            print(title)
+        for row in self.rows:
+            print(row.decode())
+
+    def count_water(self) -> Tuple[int, Iterator[Pos]]:
+        """Return the number of water cells within the rows of clay, and an
+        iterator over their positions, in reading order.
+        """
+        return self.count_cells((ORD_FLOW, ORD_STILL))
+
+    def count_still_water(self) -> Tuple[int, Iterator[Pos]]:
+        """Return the number of still water cells within the rows of clay,
+        and an iterator over their positions, in reading order.
+        """
+        return self.count_cells((ORD_STILL,))
+
+    def count_cells(self, cells) -> Tuple[int, Iterator[Pos]]:
+        rows = self.rows[self.clay_rowmin:self.clay_rowmax + 1]
+        count = sum(row.count(cell) for row in rows for cell in cells)
+        return count, self.positions(cells)
+
+    def positions(self, cells) -> Iterator[Pos]:
+        """Generate the positions of the given cells within the rows of
+        clay, in reading order.
+        """
+        for r in range(self.clay_rowmin, self.clay_rowmax + 1):
+            row = self.rows[r]
+            for c, cell in enumerate(row):
+                if cell in cells:
+                    yield Pos(r, c + self.left)
+
+    def fill(self) -> None:
+        """Fill the ground with water from the springs in a single pass.
+        If there is no sand under a spring, the water spreads along the
+        springs' row instead.
+        """
+        for col in self.springs:
+            if self.rows[SPRING_ROW + 1][col] == ORD_SAND:
+                self.pour(SPRING_ROW + 1, col)
+            else:
+                self.pour(SPRING_ROW, col, level=SPRING_ROW)
+                self.rows[SPRING_ROW][col] = ORD_SPRING
+
+    def pour(self, top: int, col: int, level: Optional[int] = None) -> bool:
+        """Pour water into the sand at row top, and let it fall and fill the
+        ground below.  Return True if the water flows out of the scan, or
+        False if it is held.  If level is given, the water is already
+        standing on a floor at that row.  Falls are kept on a stack, as in
+        Board.pour().
+        """
+        rows = self.rows
+        stack = [(top, col, level)]
+        while stack:
+            start, col, row = stack.pop()
+            key = (start, col)
+            if row is None:
+                if key in self.flows_out:
+                    continue
+                row = start
+                rows[row][col] = ORD_FLOW
+                while row < self.rowmax and rows[row + 1][col] == ORD_SAND:
+                    row += 1
+                    rows[row][col] = ORD_FLOW
+                if row == self.rowmax or rows[row + 1][col] == ORD_FLOW:
+                    self.flows_out[key] = True
+                    continue
+
+            fall = None
+            while row >= start:
+                left, left_edge = self.spread(row, col, -1)
+                if left_edge == FALL:
+                    fall = left
+                    break
+                right, right_edge = self.spread(row, col, 1)
+                if right_edge == FALL:
+                    fall = right
+                    break
+                if DRAIN in (left_edge, right_edge):
+                    rows[row][left:right + 1] = FLOW.encode() * (right - left + 1)
+                    break
+                rows[row][left:right + 1] = STILL.encode() * (right - left + 1)
+                row -= 1
+
+            if fall is not None:
+                stack.append((start, col, row))
+                stack.append((row + 1, fall, None))
+            else:
+                self.flows_out[key] = row >= start
+        return self.flows_out.get((top, col), True)
+
+    def spread(self, row: int, col: int, step: int) -> Tuple[int, str]:
+        """Spread water across a row from col, in the direction given by
+        step.  Return the last column reached, and how the row ends there:
+        WALL, DRAIN or FALL.
+        """
+        cells, below = self.rows[row], self.rows[row + 1]
+        while True:
+            if below[col] == ORD_SAND:
+                return col, FALL
+            if below[col] == ORD_FLOW:
+                return col, DRAIN
+            if cells[col + step] == ORD_CLAY:
+                return col, WALL
+            col += step
+
+    def settle(self) -> None:
+        """Fill the ground by applying the rules to every cell, over and
+        over, until nothing changes.  Sand under water, or beside water
+        that stands on clay or still water, becomes flowing water.  A run
+        of flowing water between two clay walls, all of it on clay or
+        still water, becomes still.  Much slower than fill(), but simple
+        enough to check the other solvers against.
+        """
+        rows = self.rows
+        floor = (ORD_CLAY, ORD_STILL)
+        changed = True
+        while changed:
+            changed = False
+            for r, cells in enumerate(rows):
+                above = rows[r - 1] if r > 0 else None
+                below = rows[r + 1] if r < self.rowmax else None
+                for c in range(self.width):
+                    if cells[c] != ORD_SAND:
+                        continue
+                    wet = above is not None and above[c] in (ORD_FLOW, ORD_SPRING)
+                    for n in (c - 1, c + 1):
+                        if (0 <= n < self.width and below is not None
+                                and cells[n] in (ORD_FLOW, ORD_SPRING)
+                                and below[n] in floor):
+                            wet = True
+                    if wet:
+                        cells[c] = ORD_FLOW
+                        changed = True
+
+                c = 0
+                while c < self.width:
+                    if cells[c] != ORD_FLOW:
+                        c += 1
+                        continue
+                    first = c
+                    while c < self.width and cells[c] == ORD_FLOW:
+                        c += 1
+                    if (below is not None and 0 < first and c < self.width
+                            and cells[first - 1] == ORD_CLAY and cells[c] == ORD_CLAY
+                            and all(below[n] in floor for n in range(first, c))):
+                        cells[first:c] = STILL.encode() * (c - first)
+                        changed = True
+
+
+def split_bands(
+    veins: Sequence[Vein],
+    springs: Sequence[int],
+    bands: int
+) -> List[Tuple[Bounds, List[Vein], List[int]]]:
+    """Split a scan into at most the given number of vertical bands, of
+    roughly equal width, and return the bounds, veins and springs of each.
+
+    Bands are divided at columns with no clay.  Water can't rest in such a
+    column, so any that reaches one falls straight out of the scan, and
+    nothing crosses from one band to the next.  Neighbouring bands share
+    the dividing column, where water may fall from either side.
+    """
+    first, last, rowmin, rowmax = scan_bounds(veins, springs)
+    clay_cols = bytearray(last + 1 - first)
+    for col1, col2, _, _ in veins:
+        clay_cols[col1 - first:col2 - first + 1] = b"\x01" * (col2 - col1 + 1)
+    open_cols = [first + i for i, clay in enumerate(clay_cols) if not clay]
+
+    cuts = [first]
+    for n in range(1, bands):
+        target = first + n * (last - first) // bands
+        i = bisect_left(open_cols, target)
+        if i < len(open_cols) and open_cols[i] > cuts[-1] and open_cols[i] < last:
+            cuts.append(open_cols[i])
+    cuts.append(last)
+
+    return [
+        (
+            (left, right, rowmin, rowmax),
+            [vein for vein in veins if left < vein[0] <= right],
+            [col for col in springs if left < col <= right],
+        )
+        for left, right in zip(cuts, cuts[1:])
+    ]
+
+
+def _fill_band(args) -> Tuple[int, List[bytes]]:
+    bounds, veins, springs = args
+    board = GridBoard(veins, springs, bounds)
+    board.fill()
+    return board.left, [bytes(row) for row in board.rows]
+
+
+def fill_parallel(
+    veins: Sequence[Vein],
+    springs: Sequence[int] = (SPRING_COL,),
+    workers: int = 0,
+    bands: int = 0
+) -> GridBoard:
+    """Return a GridBoard filled with water, simulating vertical bands of
+    the scan at once in a process pool.  See split_bands().  Each band's
+    rows are copied into the full grid, and where bands meet, water from
+    either side is kept.  The result is the same as a serial fill().
+    """
+    workers = workers or os.cpu_count() or 1
+    bands = bands or 4 * workers
+    board = GridBoard(veins, springs)
+    tasks = split_bands(veins, springs, bands)
+    with multiprocessing.Pool(workers) as pool:
+        for left, band_rows in pool.imap_unordered(_fill_band, tasks):
+            start = left - board.left
+            end = start + len(band_rows[0])
+            for row, band_row in zip(board.rows, band_rows):
+                # Keep water that fell down a shared edge column from the
+                # other side.
+                edges = (start, row[start]), (end - 1, row[end - 1])
+                row[start:end] = band_row
+                for col, cell in edges:
+                    if cell != ORD_SAND:
+                        row[col] = cell
+    return board
+
+
+def fill_board(
+    lines: Lines,
+    board_cls: type = GridBoard,
+    stepped: bool = False,
+    workers: int = 0
+):
+    """Return a board of the given class, filled with water from the
+    spring.  If stepped is True, a Board is propagated one time step at a
+    time instead.  If workers is given, a GridBoard is filled in bands,
+    with that many processes.
+    """
+    if workers:
+        return fill_parallel(parse_veins(lines), workers=workers)
+    if stepped:
+        board = Board.from_lines(lines)
+        board.run()
+    else:
+        board = board_cls.from_lines(lines)
+        board.fill()
+    return board
+
+
+def solve2(
+    lines: Lines,
+    board_cls: type = GridBoard,
+    stepped: bool = False,
+    workers: int = 0
+) -> int:
+    """Solve the problem.  If stepped is True, the water is propagated one
+    time step at a time, rather than filled in a single pass.  Both give
+    the same answer: a row of water is only held up by clay or still
+    water, never by flowing water.  If workers is given, the scan is
+    filled in bands with that many processes.
+    """
+    board = fill_board(lines, board_cls, stepped, workers)
     # board.print(title="final:")
-    water = board.count_still_water()
-    return len(water)
-
-def solve(lines: Lines) -> int:
-    """Solve the problem."""
-    board = Board.from_lines(lines)
-    # board.print(title="initially")
-    board.run()
+    count, _ = board.count_still_water()
+    return count
+
+def solve(
+    lines: Lines,
+    board_cls: type = GridBoard,
+    stepped: bool = False,
+    workers: int = 0
+) -> int:
+    """Solve the problem.  If stepped is True, the water is propagated one
+    time step at a time, rather than filled in a single pass.  Both give
+    the same answer: a row of water is only held up by clay or still
+    water, never by flowing water.  If workers is given, the scan is
+    filled in bands with that many processes.
+    """
+    board = fill_board(lines, board_cls, stepped, workers)
     # board.print(title="final:")
-    water = board.count_water()
-    return len(water)
+    count, _ = board.count_water()
+    return count
+
+
+# CHECKS
+
+def random_scan(rng: random.Random, basins: int = 8, width: int = 40, height: int = 40) -> Lines:
+    """Return the lines of a small random scan of open-topped clay boxes and
+    bars, around the spring's column.
+    """
+    lines = []
+    for _ in range(basins):
+        w = rng.randint(2, 12)
+        h = rng.randint(1, 8)
+        x = SPRING_COL - width // 2 + rng.randrange(width - w)
+        y = rng.randrange(2, height - h)
+        lines.append(f"x={x}, y={y}..{y + h}")
+        lines.append(f"x={x + w}, y={y}..{y + h}")
+        lines.append(f"y={y + h}, x={x}..{x + w}")
+        bar = rng.randint(1, w)
+        bx = rng.randrange(x - 2, x + w - bar + 3)
+        lines.append(f"y={rng.randrange(1, y + h)}, x={bx}..{bx + bar}")
+    return lines
+
+
+def water_cells(board) -> Tuple[set, set]:
+    """Return the positions of all water, and of still water, on a board."""
+    return set(board.count_water()[1]), set(board.count_still_water()[1])
+
+
+def check_fill(count: int = 100, seed: int = 0) -> None:
+    """Fill random scans in a single pass and step by step, and check that
+    both end up with the same water as GridBoard.settle().
+    """
+    print(f"CHECK FILL ({count} scans, seed={seed}):")
+    rng = random.Random(seed)
+    for _ in range(count):
+        lines = random_scan(rng)
+        reference = GridBoard.from_lines(lines)
+        reference.settle()
+        expected = water_cells(reference)
+        for board_cls in (Board, GridBoard):
+            board = fill_board(lines, board_cls)
+            assert water_cells(board) == expected, (board_cls.__name__, lines)
+        board = fill_board(lines, stepped=True)
+        assert water_cells(board) == expected, ("stepped", lines)
+    print("ok")
+    print("= " * 32)
+
+
+def check_stepped(count: int = 200, seed: int = 0) -> None:
+    """Step random scans with the clay index and with the original cell by
+    cell scan for basins, and check that both end up with the same water
+    as fill().
+    """
+    print(f"CHECK STEPPED ({count} scans, seed={seed}):")
+    rng = random.Random(seed)
+    for _ in range(count):
+        lines = random_scan(rng)
+        expected = water_cells(fill_board(lines))
+        board = Board.from_lines(lines)
+        board.run()
+        assert water_cells(board) == expected, ("index", lines)
+        scanned = Board.from_lines(lines)
+        scanned.in_basin = scanned.in_basin_scan
+        scanned.run()
+        assert water_cells(scanned) == expected, ("scan", lines)
+    print("ok")
+    print("= " * 32)
 
 
 # PART 1
@@ -378,6 +968,8 @@ def part2(lines: Lines) -> None:
 
 
 if __name__ == "__main__":
+    check_fill()
+    check_stepped()
     example1()
     input_lines = load_input(INPUTFILE)
     part1(input_lines)